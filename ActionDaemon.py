@@ -0,0 +1,34 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+from BaseAction import BaseAction
+from RC4Broker import RC4Broker
+from RC4PageCache import RC4PageCache
+
+class ActionDaemon(BaseAction):
+	def run(self):
+		cache = None
+		if self._args.cache:
+			cache = RC4PageCache(self._args.cache_dir or RC4PageCache.default_cachedir())
+		broker = RC4Broker(self._rc4dev, self._args.socket, status_ttl = self._args.status_ttl, pipeline = self._args.pipeline, cache = cache)
+		try:
+			broker.serve_forever()
+		except KeyboardInterrupt:
+			pass
@@ -19,20 +19,96 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 import os
+import re
 import sys
+import glob
+import threading
+import concurrent.futures
 from BaseAction import BaseAction
+from RC4PageCache import RC4PageCache
 
 class ActionDownload(BaseAction):
+	_OPEN_DEVICE = False
+
+	def _devices(self):
+		if self._args.broker is not None:
+			return [ self._args.broker ]
+		devices = [ ]
+		for pattern in (self._args.device or [ "/dev/ttyUSB0" ]):
+			matches = sorted(glob.glob(pattern))
+			if len(matches) == 0:
+				matches = [ pattern ]
+			for devpath in matches:
+				if devpath not in devices:
+					devices.append(devpath)
+		return devices
+
+	def _has_placeholders(self):
+		return re.search(r"\{(deviceid|userinfo|device)\}", self._args.output) is not None
+
+	def _output_filename(self, devpath, params):
+		return self._substitute(self._args.output, deviceid = self._sanitize(params.deviceid), userinfo = self._sanitize(params.userinfo), device = os.path.basename(devpath))
+
+	def _claim_output(self, devpath, filename):
+		with self._claim_lock:
+			if self._args.format == "sqlite":
+				# Readouts are appended to the database, which may be shared
+				return True
+			if filename in self._claimed:
+				self._log.error("%s: Output file %s is already written by %s", devpath, filename, self._claimed[filename])
+				return False
+			if os.path.exists(filename) and not (self._args.force):
+				self._log.error("%s: Refusing to overwrite output file %s", devpath, filename)
+				return False
+			self._claimed[filename] = devpath
+			return True
+
+	def _download(self, devpath):
+		# Without placeholders, the output file is known before the device
+		# is even opened
+		if (not self._has_placeholders()) and (not self._claim_output(devpath, self._args.output)):
+			return False
+		rc4dev = self._connect(devpath)
+		try:
+			params = rc4dev.getstatus()
+			filename = self._output_filename(devpath, params)
+			if self._has_placeholders() and (not self._claim_output(devpath, filename)):
+				return False
+
+			self._log.info("%s: Reading device %s (%s) into %s", devpath, params.deviceid, params.userinfo, filename)
+			data = rc4dev.readout(pipeline = self._args.pipeline, params = params, cache = self._cache)
+			data.save(filename, self._args.format, delta = self._args.delta, compact = self._args.compact)
+			return True
+		finally:
+			self._disconnect(rc4dev)
+
+	def _download_all(self, devices):
+		success = True
+		with concurrent.futures.ThreadPoolExecutor(max_workers = len(devices)) as executor:
+			futures = { executor.submit(self._download, devpath): devpath for devpath in devices }
+			for future in concurrent.futures.as_completed(futures):
+				devpath = futures[future]
+				try:
+					if not future.result():
+						success = False
+				except Exception as e:
+					self._log.error("%s: Readout failed: %s", devpath, str(e))
+					success = False
+		return success
+
 	def run(self):
-		if os.path.exists(self._args.output) and not (self._args.force):
-			self._log.error("Refusing to overwrite output file %s", self._args.output)
+		self._claim_lock = threading.Lock()
+		self._claimed = { }
+		self._cache = None
+		if self._args.cache:
+			self._cache = RC4PageCache(self._args.cache_dir or RC4PageCache.default_cachedir())
+		devices = self._devices()
+		if len(devices) == 1:
+			success = self._download(devices[0])
+		else:
+			if (self._args.format != "sqlite") and (not self._has_placeholders()):
+				self._log.error("Reading out %d devices, but output filename %s contains none of the {deviceid}, {userinfo} or {device} placeholders", len(devices), self._args.output)
+				sys.exit(1)
+			success = self._download_all(devices)
+		if not success:
 			sys.exit(1)
-
-		data = self._rc4dev.readout()
-		with open(self._args.output, "w") as f:
-			if self._args.format == "txt":
-				data.write_txt(f)
-			elif self._args.format == "json":
-				data.write_json(f)
-			else:
-				raise Exception(NotImplemented)
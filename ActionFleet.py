@@ -0,0 +1,54 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import re
+import sys
+from BaseAction import BaseAction
+from RC4Fleet import RC4Fleet
+from RC4PageCache import RC4PageCache
+
+class ActionFleet(BaseAction):
+	_OPEN_DEVICE = False
+
+	def _on_status(self, fleetdev, params):
+		self._log.info("%s: Device %s in state %s with %d data points", fleetdev.devpath, params.deviceid, params.state.name, params.datapts)
+
+	def _on_readout(self, fleetdev, readout):
+		params = readout.params
+		filename = self._substitute(self._args.output, deviceid = self._sanitize(params.deviceid), userinfo = self._sanitize(params.userinfo), device = os.path.basename(fleetdev.devpath), stationid = params.stationid)
+		self._log.info("%s: Writing %d data points of device %s to %s", fleetdev.devpath, len(readout.samples), params.deviceid, filename)
+		readout.save(filename, self._args.format, delta = self._args.delta, compact = self._args.compact)
+		self._write_metrics_file()
+
+	def run(self):
+		if (self._args.format != "sqlite") and (re.search(r"\{(deviceid|userinfo|device|stationid)\}", self._args.output) is None):
+			self._log.error("Output filename %s contains none of the {deviceid}, {userinfo}, {device} or {stationid} placeholders", self._args.output)
+			sys.exit(1)
+		cache = None
+		if self._args.cache:
+			cache = RC4PageCache(self._args.cache_dir or RC4PageCache.default_cachedir())
+		fleet = RC4Fleet(self._args.device or [ "/dev/ttyUSB*" ], self._connect, disconnect = self._disconnect, poll_interval = self._args.poll_interval, readout_interval = self._args.readout_interval, jitter = self._args.jitter, deadline = self._args.deadline, scan_interval = self._args.scan_interval, pipeline = self._args.pipeline, cache = cache, on_status = self._on_status, on_readout = self._on_readout)
+		try:
+			fleet.run_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			fleet.shutdown()
@@ -0,0 +1,111 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import json
+import time
+import queue
+import calendar
+import datetime
+import threading
+from BaseAction import BaseAction
+from RC4PageCache import RC4MemoryPageCache
+from Commands import DeviceStateEnum
+
+class ActionWatch(BaseAction):
+	def _writer(self, f):
+		# Runs in its own thread. The bounded queue in front of it blocks the
+		# poller whenever the consumer of the output falls behind.
+		while True:
+			line = self._queue.get()
+			if line is None:
+				break
+			if self._write_error is not None:
+				continue
+			try:
+				f.write(line)
+				if self._queue.empty():
+					f.flush()
+			except (BrokenPipeError, OSError) as e:
+				self._write_error = e
+
+	def _emit_points(self, params, samples, first):
+		delta = datetime.timedelta(0, params.intervalsecs)
+		for index in range(first, len(samples)):
+			timestamp = params.startdatetime + (index * delta)
+			point = {
+				"device":	params.deviceid,
+				"index":	index,
+				"timet":	calendar.timegm(timestamp.timetuple()),
+				"iso":		timestamp.isoformat(timespec = "seconds"),
+				"value":	samples[index] / 10,
+			}
+			self._queue.put(json.dumps(point, sort_keys = True) + "\n")
+
+	def _poll(self):
+		cache = RC4MemoryPageCache()
+		acquisition = None
+		emitted = None
+		while self._write_error is None:
+			params = self._rc4dev.getstatus()
+			if params.startdatetime != acquisition:
+				acquisition = params.startdatetime
+				emitted = 0 if ((emitted is not None) or self._args.from_start) else params.datapts
+				self._log.info("Watching acquisition of %s started %s, %d data points present", params.deviceid, params.startdatetime, params.datapts)
+			elif params.datapts < emitted:
+				emitted = 0
+
+			if params.datapts > emitted:
+				# The cache holds all complete pages seen so far, so only the
+				# page(s) containing new samples are transferred
+				readout = self._rc4dev.readout(pipeline = self._args.pipeline, params = params, cache = cache)
+				self._emit_points(params, readout.samples, emitted)
+				emitted = len(readout.samples)
+
+			if params.state != DeviceStateEnum.LOGGING:
+				self._log.info("Device is in state %s, no more data points will be recorded.", params.state.name)
+				break
+			time.sleep(self._args.poll_interval)
+
+	def run(self):
+		self._queue = queue.Queue(maxsize = self._args.buffer)
+		self._write_error = None
+		if self._args.output == "-":
+			f = sys.stdout
+		else:
+			f = open(self._args.output, "a")
+		writer = threading.Thread(target = self._writer, args = (f, ))
+		writer.start()
+		try:
+			self._poll()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self._queue.put(None)
+			writer.join()
+			if f is not sys.stdout:
+				f.close()
+		if isinstance(self._write_error, BrokenPipeError):
+			# Reader went away, which is the regular way to end watching a pipe
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+		elif self._write_error is not None:
+			self._log.error("Writing output failed: %s", str(self._write_error))
+			sys.exit(1)
@@ -18,12 +18,21 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
+import re
+import sys
 import logging
-from RC4Connection import RC4Connection
+import threading
+from RC4Connection import RC4Connection, RC4Timing
 from RC4Device import RC4Device
-from HexDump import HexDump
+from RC4Broker import RC4BrokerDevice
+from RC4Metrics import RC4Metrics
+from RC4Trace import RC4RecordingTransport, RC4ReplayTransport
+from RC4DataDebugLog import RC4DataDebugLog
 
 class BaseAction(object):
+	_OPEN_DEVICE = True
+
 	def __init__(self, cmd, args):
 		self._cmd = cmd
 		self._args = args
@@ -40,17 +49,80 @@ class BaseAction(object):
 		facility.setLevel(lvl)
 		self._log = logging.getLogger("pydatalog." + self.__class__.__name__)
 
-		self._conn = RC4Connection(self._args.device, data_debug_callback = self._data_debug_callback)
-		self._rc4dev = RC4Device(self._conn)
-		self.run()
+		# Frames are only formatted at all when they are actually dumped
+		self._data_debug_callback = None
+		dump_file = None
+		if self._args.verbose >= 3:
+			if getattr(self._args, "dump_file", None) is not None:
+				dump_file = open(self._args.dump_file, "w")
+				self._data_debug_callback = RC4DataDebugLog(dump_file, background = True)
+			else:
+				self._data_debug_callback = RC4DataDebugLog()
+
+		self._metrics = { }
+		self._metrics_lock = threading.Lock()
+		self._connections = [ ]
+		if self._OPEN_DEVICE:
+			self._rc4dev = self._connect(self._args.device)
+		try:
+			self.run()
+		finally:
+			self._report_metrics()
+			for rc4dev in self._connections:
+				rc4dev.close()
+			if self._data_debug_callback is not None:
+				self._data_debug_callback.close()
+			if dump_file is not None:
+				dump_file.close()
 
+	@staticmethod
+	def _substitute(template, **placeholders):
+		# Only the given placeholders are replaced, so that other braces in
+		# user supplied filenames are left alone
+		for (name, value) in placeholders.items():
+			template = template.replace("{" + name + "}", str(value))
+		return template
 
+	@staticmethod
+	def _sanitize(text):
+		# Makes device supplied strings safe for use in filenames
+		return re.sub(r"[^A-Za-z0-9._-]+", "_", text).strip("_")
 
-	def _data_debug_callback(self, identifier, data):
-		if self._args.verbose >= 3:
-			print("%s (%d bytes)" % (identifier, len(data)))
-			HexDump().dump(data)
-			print()
+	def _connect(self, devpath):
+		if getattr(self._args, "broker", None) is not None:
+			rc4dev = RC4BrokerDevice(self._args.broker)
+		else:
+			timing = RC4Timing(read_timeout = self._args.read_timeout, settle_time = self._args.settle_time, ready_poll_interval = self._args.ready_poll)
+			transport = None
+			if getattr(self._args, "replay", None) is not None:
+				transport = RC4ReplayTransport(self._substitute(self._args.replay, device = os.path.basename(devpath)), speed = self._args.replay_speed)
+			elif getattr(self._args, "record", None) is not None:
+				transport = RC4RecordingTransport(RC4Connection.open_serial(devpath), self._substitute(self._args.record, device = os.path.basename(devpath)))
+			conn = RC4Connection(devpath, data_debug_callback = self._data_debug_callback, transport = transport, retries = self._args.retries, retry_writes = self._args.retry_writes, timing = timing)
+			rc4dev = RC4Device(conn)
+			with self._metrics_lock:
+				self._metrics[devpath] = conn.metrics
+		# Connections still open when the action ends are closed then
+		with self._metrics_lock:
+			self._connections.append(rc4dev)
+		return rc4dev
+
+	def _disconnect(self, rc4dev):
+		with self._metrics_lock:
+			self._connections.remove(rc4dev)
+		rc4dev.close()
+
+	def _write_metrics_file(self):
+		if getattr(self._args, "stats_file", None) is not None:
+			with self._metrics_lock:
+				RC4Metrics.write_file(self._args.stats_file, self._metrics)
+
+	def _report_metrics(self):
+		if getattr(self._args, "stats", False):
+			for (devpath, metrics) in sorted(self._metrics.items()):
+				print("Protocol statistics for %s:" % (devpath), file = sys.stderr)
+				metrics.dump(sys.stderr)
+		self._write_metrics_file()
 
 	def run(self):
 		raise Exception(NotImplemented)
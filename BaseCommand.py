@@ -18,9 +18,15 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
-import datetime
+import operator
+from BinaryLayout import LayoutDecodeError
 
 class BaseCommand(object):
+	# Commands that only read from the device can safely be repeated when
+	# their response is lost. All others change the state of the device and
+	# are only retried on request.
+	IDEMPOTENT = False
+
 	def __init__(self):
 		pass
 
@@ -29,8 +35,36 @@ class BaseCommand(object):
 		raise Exception(NotImplemented)
 
 class BaseResponse(object):
+	_LAYOUT = None
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		if cls._LAYOUT is not None:
+			for name in cls._LAYOUT.names:
+				if name not in cls.__dict__:
+					setattr(cls, name, property(operator.methodcaller("_field", name)))
+
 	def __init__(self, data):
+		# All fields are decoded once into a record. A field that cannot be
+		# decoded, like an unknown state, only fails when it is read and does
+		# not affect the others. Frames too short for the layout are caught
+		# by lengthok().
 		self._data = data
+		self._record = None
+		if (self._LAYOUT is not None) and (len(data) >= self._LAYOUT.length):
+			self._record = self._LAYOUT.unpack(data, defer_errors = True)
+
+	@property
+	def frame(self):
+		return self._data
+
+	def _field(self, name):
+		if self._record is None:
+			raise Exception("Frame of %d bytes is too short to contain field %s." % (len(self._data), name))
+		value = getattr(self._record, name)
+		if isinstance(value, LayoutDecodeError):
+			raise value.exception
+		return value
 
 	@staticmethod
 	def readlength():
@@ -38,35 +72,3 @@ class BaseResponse(object):
 
 	def lengthok(self):
 		return self.readlength() == len(self._data)
-
-	@staticmethod
-	def _convert_sint(value, bits):
-		half = 1 << (bits - 1)
-		if value >= half:
-			value = -((1 << bits) - value)
-		return value
-
-	def _decode_uint8(self, offset):
-		return self._data[offset]
-
-	def _decode_uint16(self, offset):
-		return (self._data[offset + 0] << 8) | (self._data[offset + 1] << 0)
-
-	def _decode_sint8(self, offset):
-		return self._convert_sint(self._decode_uint8(offset), 8)
-
-	def _decode_sint16(self, offset):
-		return self._convert_sint(self._decode_uint16(offset), 16)
-
-	def _decode_datetime(self, offset):
-		time_tuple = (self._decode_uint16(offset), self._decode_uint8(offset + 2), self._decode_uint8(offset + 3), self._decode_uint8(offset + 4), self._decode_uint8(offset + 5), self._decode_uint8(offset + 6))
-		if time_tuple == (65535, 255, 255, 255, 255, 255):
-			return None
-		else:
-			return datetime.datetime(*time_tuple)
-
-	def _decode_string(self, offset, length):
-		data = self._data[offset : offset + length]
-		data = data.rstrip(b"\x00")
-		data = data.lstrip(b"\xff")
-		return data.decode("utf-8")
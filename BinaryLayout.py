@@ -0,0 +1,181 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import struct
+import datetime
+import fractions
+import collections
+
+class LayoutField(object):
+	def __init__(self, name, offset, fmt, decode = None, encode = None, default = None):
+		self.name = name
+		self.offset = offset
+		self.fmt = fmt
+		self.size = struct.calcsize(">" + fmt)
+		self.count = len(struct.unpack(">" + fmt, bytes(self.size)))
+		self.decode = decode if (decode is not None) else (lambda value: value)
+		self.encode = encode if (encode is not None) else (lambda value: value)
+		self.default = default
+
+	@classmethod
+	def uint8(cls, name, offset, **kwargs):
+		return cls(name, offset, "B", **kwargs)
+
+	@classmethod
+	def sint8(cls, name, offset, **kwargs):
+		return cls(name, offset, "b", **kwargs)
+
+	@classmethod
+	def uint16(cls, name, offset, **kwargs):
+		return cls(name, offset, "H", **kwargs)
+
+	@classmethod
+	def sint16(cls, name, offset, **kwargs):
+		return cls(name, offset, "h", **kwargs)
+
+	@classmethod
+	def uint32(cls, name, offset, **kwargs):
+		return cls(name, offset, "L", **kwargs)
+
+	@classmethod
+	def sint64(cls, name, offset, **kwargs):
+		return cls(name, offset, "q", **kwargs)
+
+	@classmethod
+	def constant(cls, offset, value):
+		return cls(None, offset, "%ds" % (len(value)), default = value)
+
+	@classmethod
+	def fixedpoint(cls, name, offset, fmt, divisor):
+		return cls(name, offset, fmt, decode = lambda value: fractions.Fraction(value, divisor), encode = lambda value: round(value * divisor))
+
+	@classmethod
+	def enum(cls, name, offset, fmt, enumclass):
+		return cls(name, offset, fmt, decode = enumclass, encode = int)
+
+	@classmethod
+	def hms_interval(cls, name, offset):
+		def decode(value):
+			return (value[0] * 3600) + (value[1] * 60) + value[2]
+		def encode(secs):
+			return (secs // 3600, secs % 3600 // 60, secs % 60)
+		return cls(name, offset, "3B", decode = decode, encode = encode)
+
+	@classmethod
+	def datetime(cls, name, offset):
+		def decode(value):
+			if value == (65535, 255, 255, 255, 255, 255):
+				return None
+			return datetime.datetime(*value)
+		def encode(ts):
+			if ts is None:
+				return (65535, 255, 255, 255, 255, 255)
+			return (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
+		return cls(name, offset, "H5B", decode = decode, encode = encode)
+
+	@classmethod
+	def string(cls, name, offset, length):
+		def decode(value):
+			return value.rstrip(b"\x00").lstrip(b"\xff").decode("utf-8")
+		def encode(text):
+			data = text.encode("utf-8")
+			if len(data) > length:
+				raise Exception("String field %s may only have %d chars at max" % (name, length))
+			return data
+		return cls(name, offset, "%ds" % (length), decode = decode, encode = encode, default = "")
+
+class LayoutDecodeError(object):
+	# Stands in for a field that could not be decoded, see BinaryLayout.unpack()
+	__slots__ = ("exception", )
+
+	def __init__(self, exception):
+		self.exception = exception
+
+class BinaryLayout(object):
+	def __init__(self, length, fields, byteorder = ">"):
+		self._length = length
+		self._fields = sorted(fields, key = lambda field: field.offset)
+
+		fmt = byteorder
+		position = 0
+		for field in self._fields:
+			if field.offset < position:
+				raise Exception("Layout field %s at offset %d overlaps previous field." % (field.name, field.offset))
+			if field.offset > position:
+				fmt += "%dx" % (field.offset - position)
+			fmt += field.fmt
+			position = field.offset + field.size
+		if position > length:
+			raise Exception("Layout fields exceed total length of %d bytes." % (length))
+		if position < length:
+			fmt += "%dx" % (length - position)
+		self._struct = struct.Struct(fmt)
+
+		self._slices = [ ]
+		index = 0
+		for field in self._fields:
+			if field.count == 1:
+				self._slices.append((field, index, None))
+			else:
+				self._slices.append((field, index, index + field.count))
+			index += field.count
+		self._named_slices = [ entry for entry in self._slices if entry[0].name is not None ]
+		self._record = collections.namedtuple("Record", [ field.name for (field, start, end) in self._named_slices ])
+
+	@property
+	def length(self):
+		return self._length
+
+	@property
+	def names(self):
+		return self._record._fields
+
+	def unpack(self, data, defer_errors = False):
+		# Decodes all fields in a single pass. With defer_errors, a field that
+		# cannot be decoded holds a LayoutDecodeError instead of failing the
+		# whole record.
+		values = self._struct.unpack_from(data)
+		decoded = [ ]
+		for (field, start, end) in self._named_slices:
+			value = values[start] if (end is None) else values[start : end]
+			if defer_errors:
+				try:
+					value = field.decode(value)
+				except Exception as e:
+					value = LayoutDecodeError(e)
+			else:
+				value = field.decode(value)
+			decoded.append(value)
+		return self._record._make(decoded)
+
+	def pack(self, **values):
+		raw = [ ]
+		for (field, start, end) in self._slices:
+			if (field.name is not None) and (field.name in values):
+				value = field.encode(values[field.name])
+			elif field.default is not None:
+				value = field.default if (field.name is None) else field.encode(field.default)
+			else:
+				raise Exception("No value given for layout field %s." % (field.name))
+			if end is None:
+				raw.append(value)
+			else:
+				raw += value
+		return self._struct.pack(*raw)
@@ -18,10 +18,13 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import sys
+import array
 import fractions
 import enum
 import datetime
 from BaseCommand import BaseCommand, BaseResponse
+from BinaryLayout import BinaryLayout, LayoutField
 
 def int16(value):
 	value = value & 0xffff
@@ -29,6 +32,8 @@ def int16(value):
 
 
 class CommandGetDataInit(BaseCommand):
+	IDEMPOTENT = True
+
 	@staticmethod
 	def commandid():
 		return 0x01
@@ -37,16 +42,18 @@ class CommandGetDataInit(BaseCommand):
 		return b"\x00"
 
 	class Response(BaseResponse):
+		_LAYOUT = BinaryLayout(11, [
+			LayoutField.datetime("startdatetime", 0x3),
+		])
+
 		@staticmethod
 		def readlength():
 			return 11
 
-		@property
-		def startdatetime(self):
-			return self._decode_datetime(0x3)
-
 
 class CommandDownloadDataPage(BaseCommand):
+	IDEMPOTENT = True
+
 	def __init__(self, pageno):
 		self._pageno = pageno
 
@@ -69,11 +76,30 @@ class CommandDownloadDataPage(BaseCommand):
 		def datapts(self):
 			return (len(self._data) - 2) // 2
 
+		@property
+		def samples(self):
+			# Signed big-endian 16 bit values in units of 0.1 degrees
+			samples = array.array("h", self._data[1 : 1 + (2 * self.datapts)])
+			if sys.byteorder == "little":
+				samples.byteswap()
+			return samples
+
 		@property
 		def data(self):
-			return [ fractions.Fraction(self._decode_sint16(offset), 10) for offset in range(1, len(self._data) - 1, 2) ]
+			return [ fractions.Fraction(value, 10) for value in self.samples ]
 
 class CommandSetParameters(BaseCommand):
+	_LAYOUT = BinaryLayout(21, [
+		LayoutField.constant(0, b"\x00"),
+		LayoutField.hms_interval("loginterval_secs", 1),
+		LayoutField.sint16("temp_upper", 4),
+		LayoutField.sint16("temp_lower", 6),
+		LayoutField.uint8("stationid", 8),
+		LayoutField.constant(9, b"\x31\x00\x31\x00\x31"),
+		LayoutField.sint8("temp_calibration", 14),
+		LayoutField.constant(15, bytes(6)),
+	])
+
 	def __init__(self, **kwargs):
 		self._loginterval_secs = kwargs.get("logintvl", 60)
 		self._temp_upper = 600
@@ -86,17 +112,7 @@ class CommandSetParameters(BaseCommand):
 		return 0x05
 
 	def serialize(self):
-		cmd = b"\x00"
-		cmd += bytes([ self._loginterval_secs // 3600, self._loginterval_secs % 3600 // 60, self._loginterval_secs % 3600 % 60 ])
-		cmd += int16(self._temp_upper)
-		cmd += int16(self._temp_lower)
-		cmd += bytes([ self._station ])
-
-		cmd += b"\x31\x00"
-		cmd += b"\x31\x00"
-		cmd += bytes([ 0x31, self._temp_calibration ])
-		cmd += b"\x00\x00\x00\x00\x00\x00"
-		return cmd
+		return self._LAYOUT.pack(loginterval_secs = self._loginterval_secs, temp_upper = self._temp_upper, temp_lower = self._temp_lower, stationid = self._station, temp_calibration = self._temp_calibration)
 
 	class Response(BaseResponse):
 		@staticmethod
@@ -110,6 +126,8 @@ class DeviceStateEnum(enum.IntEnum):
 	WAITING = 3
 
 class CommandGetParameters(BaseCommand):
+	IDEMPOTENT = True
+
 	def serialize(self):
 		return b"\x00"
 
@@ -118,21 +136,26 @@ class CommandGetParameters(BaseCommand):
 		return 0x06
 
 	class Response(BaseResponse):
+		_LAYOUT = BinaryLayout(160, [
+			LayoutField.uint8("stationid", 0x1),
+			LayoutField.hms_interval("intervalsecs", 0x5),
+			LayoutField.fixedpoint("alarm_max", 0x8, "h", 10),
+			LayoutField.fixedpoint("alarm_min", 0xa, "h", 10),
+			LayoutField.datetime("lastaccessdatetime", 0xc),
+			LayoutField.enum("state", 0x13, "B", DeviceStateEnum),
+			LayoutField.datetime("startdatetime", 0x14),
+			LayoutField.uint16("datapts", 0x1d),
+			LayoutField.datetime("currentdatetime", 0x1f),
+			LayoutField.string("userinfo", 0x26, 100),
+			LayoutField.string("deviceid", 0x8a, 10),
+			LayoutField.fixedpoint("delaytime", 0x94, "b", 2),
+			LayoutField.fixedpoint("temp_cal", 0x98, "b", 10),
+		])
+
 		@staticmethod
 		def readlength():
 			return 160
 
-		def __init__(self, data):
-			BaseResponse.__init__(self, data)
-
-		@property
-		def lastaccessdatetime(self):
-			return self._decode_datetime(0xc)
-
-		@property
-		def startdatetime(self):
-			return self._decode_datetime(0x14)
-
 		@property
 		def enddatetime(self):
 			start = self.startdatetime
@@ -141,50 +164,6 @@ class CommandGetParameters(BaseCommand):
 			else:
 				return start + datetime.timedelta(0, self.datapts * self.intervalsecs)
 
-		@property
-		def currentdatetime(self):
-			return self._decode_datetime(0x1f)
-
-		@property
-		def userinfo(self):
-			return self._decode_string(0x26, 100)
-
-		@property
-		def deviceid(self):
-			return self._decode_string(0x8a, 10)
-
-		@property
-		def stationid(self):
-			return self._data[1]
-
-		@property
-		def datapts(self):
-			return self._decode_uint16(0x1d)
-
-		@property
-		def state(self):
-			return DeviceStateEnum(self._data[0x13])
-
-		@property
-		def intervalsecs(self):
-			return (self._data[5] * 3600) + (self._data[6] * 60) + self._data[7]
-
-		@property
-		def alarm_min(self):
-			return fractions.Fraction(self._decode_sint16(0xa), 10)
-
-		@property
-		def alarm_max(self):
-			return fractions.Fraction(self._decode_sint16(0x8), 10)
-
-		@property
-		def temp_cal(self):
-			return fractions.Fraction(self._decode_sint8(0x98), 10)
-
-		@property
-		def delaytime(self):
-			return fractions.Fraction(self._decode_sint8(0x94), 2)
-
 		def dump(self):
 			time_diff = (self.currentdatetime - datetime.datetime.utcnow()).total_seconds()
 			elements = [ ]
@@ -206,6 +185,11 @@ class CommandGetParameters(BaseCommand):
 			print(elements)
 
 class CommandSetDatetime(BaseCommand):
+	_LAYOUT = BinaryLayout(8, [
+		LayoutField.constant(0, b"\x00"),
+		LayoutField.datetime("timestamp", 1),
+	])
+
 	def __init__(self, timestamp):
 		self._timestamp = timestamp
 
@@ -214,10 +198,7 @@ class CommandSetDatetime(BaseCommand):
 		return 0x07
 
 	def serialize(self):
-		cmd = b"\x00"
-		cmd += int16(self._timestamp.year)
-		cmd += bytes([ self._timestamp.month, self._timestamp.day, self._timestamp.hour, self._timestamp.minute, self._timestamp.second ])
-		return cmd
+		return self._LAYOUT.pack(timestamp = self._timestamp)
 
 	class Response(BaseResponse):
 		@staticmethod
@@ -240,21 +221,23 @@ class CommandStopAcquisition(BaseCommand):
 
 
 class CommandSetUserInfo(BaseCommand):
+	_LAYOUT = BinaryLayout(101, [
+		LayoutField.constant(0, b"\x00"),
+		LayoutField.string("userinfo", 1, 100),
+	])
+
 	def __init__(self, newuserinfo):
 		assert(isinstance(newuserinfo, str))
-		self._userinfo = newuserinfo.encode("utf-8")
-		if len(self._userinfo) > 100:
+		if len(newuserinfo.encode("utf-8")) > 100:
 			raise Exception("User info may only have 100 chars at max")
-		if len(self._userinfo) < 100:
-			self._userinfo = self._userinfo + bytes([ 0 ] * (100 - len(self._userinfo)))
-		assert(len(self._userinfo) == 100)
+		self._userinfo = newuserinfo
 
 	@staticmethod
 	def commandid():
 		return 0x09
 
 	def serialize(self):
-		return b"\x00" + self._userinfo
+		return self._LAYOUT.pack(userinfo = self._userinfo)
 
 	class Response(BaseResponse):
 		@staticmethod
@@ -263,6 +246,8 @@ class CommandSetUserInfo(BaseCommand):
 
 
 class CommandNop(BaseCommand):
+	IDEMPOTENT = True
+
 	@staticmethod
 	def commandid():
 		return 0x0a
@@ -277,21 +262,23 @@ class CommandNop(BaseCommand):
 
 
 class CommandSetID(BaseCommand):
+	_LAYOUT = BinaryLayout(11, [
+		LayoutField.constant(0, b"\x00"),
+		LayoutField.string("id", 1, 10),
+	])
+
 	def __init__(self, newid):
 		assert(isinstance(newid, str))
-		self._id = newid.encode("utf-8")
-		if len(self._id) > 10:
+		if len(newid.encode("utf-8")) > 10:
 			raise Exception("ID may only have 10 chars at max")
-		if len(self._id) < 10:
-			self._id = self._id + bytes([ 0 ] * (10 - len(self._id)))
-		assert(len(self._id) == 10)
+		self._id = newid
 
 	@staticmethod
 	def commandid():
 		return 0x0b
 
 	def serialize(self):
-		return b"\x00" + self._id
+		return self._LAYOUT.pack(id = self._id)
 
 	class Response(BaseResponse):
 		@staticmethod
@@ -0,0 +1,46 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import bz2
+import gzip
+import lzma
+
+class CompressedFile(object):
+	_CODECS = {
+		".gz":	gzip,
+		".xz":	lzma,
+		".bz2":	bz2,
+	}
+
+	@classmethod
+	def codec(cls, filename):
+		return cls._CODECS.get(os.path.splitext(filename)[1].lower())
+
+	@classmethod
+	def open(cls, filename, mode = "r", codec_filename = None):
+		# The codec is chosen by the extension of codec_filename if given, which
+		# allows writing to a temporary file under a different name
+		codec = cls.codec(codec_filename or filename)
+		if codec is None:
+			return open(filename, mode)
+		if "b" not in mode:
+			mode += "t"
+		return codec.open(filename, mode)
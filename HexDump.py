@@ -24,6 +24,8 @@
 #	File UUID 941e5121-2571-4c39-a58b-975600045055
 
 class HexDump(object):
+	_HEXTABLE = [ "%02x" % (value) for value in range(256) ]
+
 	def __init__(self):
 		self._format = "full"
 		self._width = 16
@@ -34,48 +36,54 @@ class HexDump(object):
 		self._strrep = True
 		assert(len(self._misschar) == 1)
 		assert(len(self._noasciichar) == 1)
+		self._compile()
 
-	def _dumpline(self, offset, data, markers = None):
-		if markers is None:
-			markers = { }
-		line = ""
-
+	def _compile(self):
+		# The layout of a line only depends on the settings, so it is turned
+		# into a format string once and every line is then formatted in bulk
+		fmt = ""
 		if self._addr:
-			line += "%6x   " % (offset)
-
+			fmt += "%6x   "
 		for charindex in range(self._width):
-			if charindex >= len(data):
-				char = self._misschar * 3
-			else:
-				char = markers.get(offset + charindex, " ")
-				char += "%02x" % (data[charindex])
-
-			line += char
+			fmt += "%s%s"
 			for spacer in self._spacers:
-				if ((charindex + 1) % spacer) == 0:					
-					line += " "
-
+				if ((charindex + 1) % spacer) == 0:
+					fmt += " "
 		if self._strrep:
-			line += "|"
-			for charindex in range(self._width):
-				if charindex >= len(data):
-					char = self._misschar
-				else:
-					if (32 < data[charindex] < 127):
-						char = bytes([ data[charindex] ]).decode("latin1")
-					else:
-						char = self._noasciichar
-				line += char
-			line += "|"
+			fmt += "|%s|"
+		self._linefmt = fmt
+		self._missing = (self._misschar * 2, ) * self._width
+		self._nomarkers = (" ", ) * self._width
+		self._asciitable = bytes((value if (32 < value < 127) else ord(self._noasciichar)) for value in range(256))
+
+	def _dumpline(self, offset, data, markers = None):
+		hexchars = [ self._HEXTABLE[value] for value in data ]
+		if len(data) < self._width:
+			hexchars += self._missing[len(data):]
+			markerchars = (" ", ) * len(data) + (self._misschar, ) * (self._width - len(data))
+		else:
+			markerchars = self._nomarkers
+		if markers:
+			markerchars = [ markers.get(offset + charindex, " ") if (charindex < len(data)) else char for (charindex, char) in enumerate(markerchars) ]
 
-		return line
+		values = [ ]
+		if self._addr:
+			values.append(offset)
+		for (markerchar, hexchar) in zip(markerchars, hexchars):
+			values.append(markerchar)
+			values.append(hexchar)
+		if self._strrep:
+			values.append(data.translate(self._asciitable).decode("latin1") + (self._misschar * (self._width - len(data))))
+		return self._linefmt % tuple(values)
 
 	def dumpstr(self, data, markers = None):
+		data = bytes(data)
 		return [ self._dumpline(i, data[i : i + self._width], markers) for i in range(0, len(data), self._width) ]
 
-	def dump(self, data, markers = None):
-		for line in self.dumpstr(data, markers):
-			print(line)
+	def dump(self, data, markers = None, f = None):
+		lines = self.dumpstr(data, markers)
+		if len(lines) > 0:
+			print("\n".join(lines), file = f)
 
 if __name__ == "__main__":
 	mydata = "Hallo das ist ein cooler Test und hier sehe ich den utf8 Ümläut!".encode("utf-8")
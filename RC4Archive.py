@@ -0,0 +1,167 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import mmap
+import array
+import itertools
+from BinaryLayout import BinaryLayout, LayoutField
+from CompressedFile import CompressedFile
+
+class RC4ArchiveException(Exception): pass
+
+class RC4Archive(object):
+	# Fixed size little-endian header followed by one int16 per sample in
+	# tenths of degrees Celsius. Without delta encoding, sample i is found at
+	# HEADER_LENGTH + 2 * i, so any time range can be sliced out directly.
+	# With delta encoding, every sample but the first stores the difference
+	# to its predecessor, which compresses much better.
+	MAGIC = b"RC4A"
+	VERSION = 1
+	FLAG_DELTA = 0x01
+	_HEADER = BinaryLayout(160, [
+		LayoutField.constant(0, MAGIC),
+		LayoutField.uint8("version", 4, default = VERSION),
+		LayoutField.uint8("flags", 5),
+		LayoutField.uint32("intervalsecs", 8),
+		LayoutField.uint32("count", 12),
+		LayoutField.sint64("start", 16),
+		LayoutField.sint64("readout", 24),
+		LayoutField.string("deviceid", 32, 16),
+		LayoutField.string("userinfo", 48, 100),
+	], byteorder = "<")
+	HEADER_LENGTH = _HEADER.length
+
+	def __init__(self, filename):
+		self._filename = filename
+		if CompressedFile.codec(filename) is None:
+			with open(filename, "rb") as f:
+				# Empty files cannot be mapped at all
+				if os.fstat(f.fileno()).st_size < self.HEADER_LENGTH:
+					raise RC4ArchiveException("%s is not a pydatalog archive." % (filename))
+				self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		else:
+			# Compressed archives cannot be mapped and are decompressed into
+			# memory instead
+			with CompressedFile.open(filename, "rb") as f:
+				self._map = f.read()
+		if (len(self._map) < self.HEADER_LENGTH) or (self._map[:len(self.MAGIC)] != self.MAGIC):
+			raise RC4ArchiveException("%s is not a pydatalog archive." % (filename))
+		self._header = self._HEADER.unpack(self._map)
+		if self._header.version != self.VERSION:
+			raise RC4ArchiveException("%s has unsupported archive version %d." % (filename, self._header.version))
+		if self._header.intervalsecs == 0:
+			raise RC4ArchiveException("%s has an invalid interval of 0 seconds." % (filename))
+		if len(self._map) < self.HEADER_LENGTH + (2 * self._header.count):
+			raise RC4ArchiveException("%s is truncated." % (filename))
+		self._decoded = None
+
+	@staticmethod
+	def is_archive(filename):
+		with CompressedFile.open(filename, "rb") as f:
+			return f.read(len(RC4Archive.MAGIC)) == RC4Archive.MAGIC
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def deviceid(self):
+		return self._header.deviceid
+
+	@property
+	def userinfo(self):
+		return self._header.userinfo
+
+	@property
+	def intervalsecs(self):
+		return self._header.intervalsecs
+
+	@property
+	def start(self):
+		return self._header.start
+
+	@property
+	def end(self):
+		return self._header.start + (self._header.intervalsecs * self._header.count)
+
+	@property
+	def readout(self):
+		return self._header.readout
+
+	@property
+	def delta(self):
+		return (self._header.flags & self.FLAG_DELTA) != 0
+
+	def __len__(self):
+		return self._header.count
+
+	def _raw(self, first, last):
+		samples = array.array("h", self._map[self.HEADER_LENGTH + (2 * first) : self.HEADER_LENGTH + (2 * last)])
+		if sys.byteorder == "big":
+			samples.byteswap()
+		return samples
+
+	def samples(self, first = 0, last = None):
+		if last is None:
+			last = len(self)
+		first = max(0, first)
+		last = min(len(self), last)
+		if first >= last:
+			return array.array("h")
+		if not self.delta:
+			return self._raw(first, last)
+		if self._decoded is None:
+			self._decoded = array.array("h", itertools.accumulate(self._raw(0, len(self))))
+		return self._decoded[first : last]
+
+	def index_range(self, t_from = None, t_to = None):
+		# Indices of all samples with t_from <= timestamp < t_to
+		first = 0 if (t_from is None) else -((self.start - t_from) // self.intervalsecs)
+		last = len(self) if (t_to is None) else -((self.start - t_to) // self.intervalsecs)
+		return (max(0, min(first, len(self))), max(0, min(last, len(self))))
+
+	def close(self):
+		if isinstance(self._map, mmap.mmap):
+			self._map.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	@classmethod
+	def write(cls, f, deviceid, userinfo, intervalsecs, start, readout, samples, delta = False):
+		samples = array.array("h", samples)
+		flags = 0
+		if delta and (len(samples) > 0):
+			deltas = [ samples[0] ] + [ current - previous for (previous, current) in zip(samples, samples[1:]) ]
+			# Steps that do not fit into 16 bits cannot be delta encoded, in
+			# which case the plain samples are stored instead
+			if all(-32768 <= value <= 32767 for value in deltas):
+				samples = array.array("h", deltas)
+				flags |= cls.FLAG_DELTA
+		header = cls._HEADER.pack(flags = flags, intervalsecs = intervalsecs, count = len(samples), start = start, readout = readout, deviceid = deviceid, userinfo = userinfo)
+		if sys.byteorder == "big":
+			samples.byteswap()
+		f.write(header)
+		f.write(samples.tobytes())
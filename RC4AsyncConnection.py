@@ -0,0 +1,233 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import tty
+import time
+import logging
+import termios
+import asyncio
+import collections
+from RC4Connection import RC4Connection, RC4Timing, RC4CommunicationException, RC4TimeoutException, RC4FrameException
+from Commands import CommandNop
+from RC4Metrics import RC4Metrics
+
+class RC4AsyncConnection(object):
+	_log = logging.getLogger("pydatalog.RC4AsyncConnection")
+
+	def __init__(self, devpath, data_debug_callback = None, retries = 0, retry_writes = False, timing = None):
+		self._fd = os.open(devpath, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		tty.setraw(self._fd)
+		attrs = termios.tcgetattr(self._fd)
+		attrs[4] = termios.B115200
+		attrs[5] = termios.B115200
+		termios.tcsetattr(self._fd, termios.TCSANOW, attrs)
+		self._data_debug_callback = data_debug_callback
+		self._timing = timing if (timing is not None) else RC4Timing()
+		self._settle_deadline = None
+		self._retries = retries
+		self._retry_writes = retry_writes
+		self._metrics = RC4Metrics()
+		self._outstanding = collections.deque()
+		self._loop = None
+		self._rxbuf = bytearray()
+		self._rxevent = asyncio.Event()
+
+	@property
+	def metrics(self):
+		return self._metrics
+
+	@property
+	def retry_counts(self):
+		return { name: metrics.retries for (name, metrics) in self._metrics.commands.items() if (metrics.retries > 0) }
+
+	@property
+	def total_retries(self):
+		return sum(self.retry_counts.values())
+
+	def _attach(self):
+		if self._loop is None:
+			self._loop = asyncio.get_running_loop()
+			self._loop.add_reader(self._fd, self._on_readable)
+
+	def _on_readable(self):
+		try:
+			chunk = os.read(self._fd, 4096)
+		except BlockingIOError:
+			return
+		self._rxbuf += chunk
+		self._metrics.rx_bytes += len(chunk)
+		self._rxevent.set()
+
+	async def _wait_for_data(self, timeout):
+		self._rxevent.clear()
+		try:
+			await asyncio.wait_for(self._rxevent.wait(), timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	async def read(self, length, short_read_okay = False, timeout = None):
+		# The timeout restarts with every received chunk, just like the
+		# repeated serial reads in RC4Connection.read()
+		self._attach()
+		if timeout is None:
+			timeout = self._timing.read_timeout
+		while len(self._rxbuf) < length:
+			if not await self._wait_for_data(timeout):
+				if not short_read_okay:
+					raise RC4TimeoutException("Timeout when trying to read %d bytes from device. %d bytes received before timeout." % (length, len(self._rxbuf)))
+				break
+		read_data = bytes(self._rxbuf[:length])
+		del self._rxbuf[:length]
+		return read_data
+
+	async def _write(self, data):
+		self._attach()
+		while len(data) > 0:
+			try:
+				written = os.write(self._fd, data)
+				data = data[written:]
+			except BlockingIOError:
+				writable = self._loop.create_future()
+				self._loop.add_writer(self._fd, writable.set_result, None)
+				try:
+					await writable
+				finally:
+					self._loop.remove_writer(self._fd)
+
+	def _data_debug(self, identifier, data):
+		if self._data_debug_callback is not None:
+			self._data_debug_callback(identifier, data)
+
+	async def _discard(self, timeout = None):
+		self._attach()
+		if timeout is None:
+			timeout = self._timing.read_timeout
+		while await self._wait_for_data(timeout):
+			pass
+		discarded = bytes(self._rxbuf)
+		self._rxbuf = bytearray()
+		self._metrics.discarded_bytes += len(discarded)
+		if len(discarded) > 0:
+			self._data_debug("<- RX (discarded)", discarded)
+		return len(discarded)
+
+	async def drain(self, timeout = None):
+		discarded = await self._discard(timeout = timeout)
+		self._outstanding.clear()
+		return discarded
+
+	def require_settle(self):
+		self._settle_deadline = self._loop_time() + self._timing.settle_time
+
+	def _loop_time(self):
+		self._attach()
+		return self._loop.time()
+
+	async def _await_ready(self):
+		# See RC4Connection._await_ready()
+		deadline = self._settle_deadline
+		self._settle_deadline = None
+		nop_length = CommandNop.Response.readlength()
+		probes = 0
+		acknowledged = False
+		while self._loop_time() < deadline:
+			await self._transmit_frame(RC4Connection._build_frame(CommandNop()))
+			probes += 1
+			rxdata = await self.read(nop_length, short_read_okay = True, timeout = self._timing.ready_poll_interval)
+			if (len(rxdata) == nop_length) and RC4Connection._checkframe(rxdata):
+				self._data_debug("<- RX", rxdata)
+				acknowledged = True
+				break
+			await self._discard(timeout = self._timing.ready_poll_interval)
+		if probes > (1 if acknowledged else 0):
+			await self._discard(timeout = self._timing.ready_poll_interval)
+
+	async def _transmit_frame(self, txdata):
+		self._data_debug("-> TX", txdata)
+		await self._write(txdata)
+		self._metrics.tx_bytes += len(txdata)
+
+	async def transmit(self, command, stationid = None):
+		if self._settle_deadline is not None:
+			await self._await_ready()
+		txdata = RC4Connection._build_frame(command, stationid = stationid)
+		await self._transmit_frame(txdata)
+		metrics = self._metrics.command(command.__class__.__name__)
+		metrics.requests += 1
+		metrics.tx_bytes += len(txdata)
+		self._outstanding.append((metrics, time.monotonic()))
+
+	async def receive(self, rspclass, short_read_okay = False, length = None):
+		# See RC4Connection.receive() on how responses are attributed
+		(metrics, sent) = self._outstanding.popleft() if (len(self._outstanding) > 0) else (None, None)
+		try:
+			if length is None:
+				rxdata = await self.read(rspclass.readlength(), short_read_okay = short_read_okay)
+			else:
+				rxdata = await self.read(length)
+				if length < rspclass.readlength():
+					if RC4Connection._checkframe(rxdata):
+						# Pick up whatever the tty already holds without waiting
+						self._on_readable()
+						if len(self._rxbuf) > 0:
+							await self._discard()
+					else:
+						rxdata += await self.read(rspclass.readlength() - length, short_read_okay = True)
+			response = RC4Connection._parse_frame(rspclass, rxdata)
+		except RC4TimeoutException:
+			if metrics is not None:
+				metrics.timeouts += 1
+			raise
+		except RC4FrameException:
+			if metrics is not None:
+				metrics.checksum_errors += 1
+			raise
+		if metrics is not None:
+			metrics.add_latency(time.monotonic() - sent)
+			metrics.rx_bytes += len(rxdata)
+		self._data_debug("<- RX", rxdata)
+		return response
+
+	def _retries_for(self, command):
+		if command.IDEMPOTENT or self._retry_writes:
+			return self._retries
+		return 0
+
+	async def send(self, command, stationid = None, short_read_okay = False, length = None):
+		attempt = 0
+		while True:
+			await self.transmit(command, stationid = stationid)
+			try:
+				return await self.receive(command.Response, short_read_okay = short_read_okay, length = length)
+			except RC4CommunicationException as e:
+				if attempt >= self._retries_for(command):
+					raise
+				attempt += 1
+				self._metrics.command(command.__class__.__name__).retries += 1
+				self._log.info("%s failed (%s), retrying (attempt %d of %d)", command.__class__.__name__, str(e), attempt, self._retries_for(command))
+				await self.drain()
+
+	def close(self):
+		if self._loop is not None:
+			self._loop.remove_reader(self._fd)
+			self._loop = None
+		os.close(self._fd)
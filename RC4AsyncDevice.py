@@ -0,0 +1,75 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import datetime
+import logging
+
+from RC4Device import RC4DeviceBase
+from Commands import CommandNop, CommandSetID, CommandSetUserInfo, CommandSetDatetime, CommandSetParameters, CommandStopAcquisition
+
+class RC4AsyncDevice(RC4DeviceBase):
+	_log = logging.getLogger("pydatalog.RC4AsyncDevice")
+
+	async def _run(self, operations):
+		try:
+			operation = next(operations)
+			while True:
+				(name, args, kwargs) = operation
+				try:
+					result = await getattr(self._conn, name)(*args, **kwargs)
+				except Exception as e:
+					operation = operations.throw(e)
+				else:
+					operation = operations.send(result)
+		except StopIteration as e:
+			return e.value
+
+	async def getstatus(self):
+		return await self._run(self._getstatus())
+
+	async def readout(self, pipeline = 1, params = None, cache = None):
+		return await self._run(self._readout(pipeline, params, cache))
+
+	async def nop(self):
+		await self._run(self._command(CommandNop()))
+
+	async def stopacquisition(self):
+		await self._run(self._command(CommandStopAcquisition()))
+
+	async def setdatetime(self, timestamp):
+		await self._run(self._command(CommandSetDatetime(timestamp)))
+
+	async def synclocaltime(self):
+		await self.setdatetime(datetime.datetime.now())
+
+	async def syncutctime(self):
+		await self.setdatetime(datetime.datetime.utcnow())
+
+	async def setup(self, logintvl):
+		await self._run(self._command(CommandSetParameters(logintvl = logintvl)))
+
+	async def set_userinfo(self, info):
+		await self._run(self._command(CommandSetUserInfo(info)))
+
+	async def set_idinfo(self, info):
+		await self._run(self._command(CommandSetID(info)))
+
+	def close(self):
+		self._conn.close()
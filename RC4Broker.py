@@ -0,0 +1,241 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+import time
+import socket
+import base64
+import logging
+import datetime
+import threading
+import socketserver
+import concurrent.futures
+from RC4Device import RC4Readout
+from Commands import CommandGetParameters, CommandDownloadDataPage
+
+class RC4Broker(object):
+	_log = logging.getLogger("pydatalog.RC4Broker")
+
+	def __init__(self, rc4dev, socketpath, status_ttl = 5, pipeline = 1, cache = None):
+		self._rc4dev = rc4dev
+		self._socketpath = socketpath
+		self._status_ttl = status_ttl
+		self._pipeline = pipeline
+		self._cache = cache
+		self._device_lock = threading.Lock()
+		self._state_lock = threading.Lock()
+		self._status = None
+		self._status_time = None
+		self._pending_readouts = { }
+
+	@staticmethod
+	def default_socketpath():
+		return os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "pydatalog.sock")
+
+	def _set_status(self, params):
+		with self._state_lock:
+			self._status = params
+			self._status_time = time.monotonic()
+
+	def _invalidate_status(self):
+		with self._state_lock:
+			self._status = None
+
+	def _cached_status(self):
+		with self._state_lock:
+			if (self._status is not None) and (time.monotonic() - self._status_time < self._status_ttl):
+				return self._status
+		return None
+
+	def status(self):
+		params = self._cached_status()
+		if params is None:
+			with self._device_lock:
+				params = self._cached_status()
+				if params is None:
+					params = self._rc4dev.getstatus()
+					self._set_status(params)
+		return params
+
+	def readout(self, params = None):
+		# Concurrent requesters of the same status all wait for the same
+		# single readout
+		key = None if (params is None) else params.frame
+		with self._state_lock:
+			future = self._pending_readouts.get(key)
+			leader = future is None
+			if leader:
+				future = concurrent.futures.Future()
+				self._pending_readouts[key] = future
+		if not leader:
+			self._log.debug("Joining readout already in progress")
+			return future.result()
+
+		try:
+			with self._device_lock:
+				readout = self._rc4dev.readout(pipeline = self._pipeline, params = params, cache = self._cache)
+			self._set_status(readout.params)
+			future.set_result(readout)
+		except Exception as e:
+			future.set_exception(e)
+		finally:
+			with self._state_lock:
+				del self._pending_readouts[key]
+		return future.result()
+
+	def _modify(self, method, *args):
+		with self._device_lock:
+			method(*args)
+			self._invalidate_status()
+
+	def handle_request(self, request):
+		cmd = request.get("cmd")
+		if cmd == "status":
+			return { "params": self.status().frame.hex() }
+		elif cmd == "readout":
+			# Only the pages the requester has not cached yet are sent
+			params = None
+			if "params" in request:
+				params = CommandGetParameters.Response(bytes.fromhex(request["params"]))
+			readout = self.readout(params)
+			pages = readout.pages[int(request.get("first_page", 0)) : ]
+			return { "params": readout.params.frame.hex(), "pages": [ base64.b64encode(page.frame).decode("ascii") for page in pages ] }
+		elif cmd == "nop":
+			self._modify(self._rc4dev.nop)
+		elif cmd == "stopacquisition":
+			self._modify(self._rc4dev.stopacquisition)
+		elif cmd == "setdatetime":
+			self._modify(self._rc4dev.setdatetime, datetime.datetime.strptime(request["timestamp"], "%Y-%m-%dT%H:%M:%S"))
+		elif cmd == "setup":
+			self._modify(self._rc4dev.setup, int(request["interval"]))
+		elif cmd == "set_userinfo":
+			self._modify(self._rc4dev.set_userinfo, request["info"])
+		elif cmd == "set_idinfo":
+			self._modify(self._rc4dev.set_idinfo, request["info"])
+		else:
+			raise Exception("Unknown broker command: %s" % (cmd))
+		return { }
+
+	def _socket_in_use(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self._socketpath)
+			return True
+		except (FileNotFoundError, ConnectionRefusedError):
+			return False
+		finally:
+			sock.close()
+
+	def serve_forever(self):
+		broker = self
+
+		class RequestHandler(socketserver.StreamRequestHandler):
+			def handle(self):
+				for line in self.rfile:
+					try:
+						response = broker.handle_request(json.loads(line))
+					except Exception as e:
+						broker._log.error("Request failed: %s", str(e))
+						response = { "error": str(e) }
+					self.wfile.write((json.dumps(response) + "\n").encode())
+					self.wfile.flush()
+
+		# A stale socket of a daemon that is gone is replaced, but one that
+		# still answers is not taken away from its daemon
+		if self._socket_in_use():
+			raise Exception("Another daemon is already serving %s." % (self._socketpath))
+		if os.path.exists(self._socketpath):
+			os.unlink(self._socketpath)
+		server = socketserver.ThreadingUnixStreamServer(self._socketpath, RequestHandler)
+		server.daemon_threads = True
+		self._log.info("Serving device on %s", self._socketpath)
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+			os.unlink(self._socketpath)
+
+class RC4BrokerDevice(object):
+	def __init__(self, socketpath):
+		self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._sock.connect(socketpath)
+		self._f = self._sock.makefile("rwb")
+
+	def _request(self, cmd, **kwargs):
+		kwargs["cmd"] = cmd
+		self._f.write((json.dumps(kwargs) + "\n").encode())
+		self._f.flush()
+		response = self._f.readline()
+		if len(response) == 0:
+			raise Exception("Broker closed the connection.")
+		response = json.loads(response)
+		if "error" in response:
+			raise Exception("Broker error: %s" % (response["error"]))
+		return response
+
+	def getstatus(self):
+		response = self._request("status")
+		return CommandGetParameters.Response(bytes.fromhex(response["params"]))
+
+	def readout(self, pipeline = 1, params = None, cache = None):
+		# Pipelining is configured on the broker side. The broker may keep a
+		# page cache of its own, but pages that are in the given cache are not
+		# transferred from the broker at all.
+		if (cache is not None) and (params is None):
+			params = self.getstatus()
+		cached = [ ] if (cache is None) else cache.load(params)[ : params.datapts // 100]
+		request = { "first_page": len(cached) }
+		if params is not None:
+			request["params"] = params.frame.hex()
+		response = self._request("readout", **request)
+		params = CommandGetParameters.Response(bytes.fromhex(response["params"]))
+		pages = cached + [ CommandDownloadDataPage.Response(base64.b64decode(page)) for page in response["pages"] ]
+		if cache is not None:
+			cache.store(params, pages)
+		return RC4Readout.from_pages(params, pages)
+
+	def nop(self):
+		self._request("nop")
+
+	def stopacquisition(self):
+		self._request("stopacquisition")
+
+	def setdatetime(self, timestamp):
+		self._request("setdatetime", timestamp = timestamp.strftime("%Y-%m-%dT%H:%M:%S"))
+
+	def synclocaltime(self):
+		self.setdatetime(datetime.datetime.now())
+
+	def syncutctime(self):
+		self.setdatetime(datetime.datetime.utcnow())
+
+	def setup(self, logintvl):
+		self._request("setup", interval = logintvl)
+
+	def set_userinfo(self, info):
+		self._request("set_userinfo", info = info)
+
+	def set_idinfo(self, info):
+		self._request("set_idinfo", info = info)
+
+	def close(self):
+		self._f.close()
+		self._sock.close()
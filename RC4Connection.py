@@ -18,15 +18,59 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import time
+import logging
+import collections
 import serial
+from Commands import CommandNop
+from RC4Metrics import RC4Metrics
+
+class RC4CommunicationException(Exception): pass
+class RC4TimeoutException(RC4CommunicationException): pass
+class RC4FrameException(RC4CommunicationException): pass
+
+class RC4Timing(object):
+	def __init__(self, read_timeout = 0.25, settle_time = 0.2, ready_poll_interval = 0.02):
+		self.read_timeout = read_timeout
+		self.settle_time = settle_time
+		self.ready_poll_interval = ready_poll_interval
 
 class RC4Connection(object):
+	_log = logging.getLogger("pydatalog.RC4Connection")
 	_ADDRESS_ALL = 0xcc
 	_ADDRESS_STATION_ID = 0x33
 
-	def __init__(self, devpath, data_debug_callback = None):
-		self._conn = serial.Serial(devpath, baudrate = 115200, timeout = 0.25)
+	def __init__(self, devpath, data_debug_callback = None, transport = None, retries = 0, retry_writes = False, timing = None):
+		self._timing = timing if (timing is not None) else RC4Timing()
+		if transport is None:
+			transport = self.open_serial(devpath)
+		self._conn = transport
+		# Replayed sessions run on the clock of the trace, so that time based
+		# decisions come out the same way as when the trace was recorded
+		self._monotonic = getattr(transport, "monotonic", time.monotonic)
+		self._conn.timeout = self._timing.read_timeout
 		self._data_debug_callback = data_debug_callback
+		self._retries = retries
+		self._retry_writes = retry_writes
+		self._settle_deadline = None
+		self._metrics = RC4Metrics()
+		self._outstanding = collections.deque()
+
+	@staticmethod
+	def open_serial(devpath):
+		return serial.Serial(devpath, baudrate = 115200)
+
+	@property
+	def metrics(self):
+		return self._metrics
+
+	@property
+	def retry_counts(self):
+		return { name: metrics.retries for (name, metrics) in self._metrics.commands.items() if (metrics.retries > 0) }
+
+	@property
+	def total_retries(self):
+		return sum(self.retry_counts.values())
 
 	def read(self, length, short_read_okay = False):
 		read_data = bytearray()
@@ -35,10 +79,11 @@ class RC4Connection(object):
 			next_chunk = self._conn.read(remaining_byte_count)
 			if len(next_chunk) == 0:
 				if not short_read_okay:
-					raise Exception("Timeout when trying to read %d bytes from device. %d bytes received before timeout." % (length, len(read_data)))
+					raise RC4TimeoutException("Timeout when trying to read %d bytes from device. %d bytes received before timeout." % (length, len(read_data)))
 				else:
 					break
 			read_data += next_chunk
+		self._metrics.rx_bytes += len(read_data)
 		return bytes(read_data)
 
 	@staticmethod
@@ -57,31 +102,155 @@ class RC4Connection(object):
 		if self._data_debug_callback is not None:
 			self._data_debug_callback(identifier, data)
 
-	def send(self, command, stationid = None, short_read_okay = False):
-		rspclass = command.Response
-		readlength = rspclass.readlength()
+	def _discard(self):
+		# Discard everything the device still sends until the line is quiet
+		discarded = bytearray()
+		while True:
+			chunk = self._conn.read(4096)
+			if len(chunk) == 0:
+				break
+			discarded += chunk
+		self._metrics.rx_bytes += len(discarded)
+		self._metrics.discarded_bytes += len(discarded)
+		if len(discarded) > 0:
+			self._data_debug("<- RX (discarded)", bytes(discarded))
+		return len(discarded)
+
+	def drain(self):
+		# Also forgets about all requests still waiting for a response
+		discarded = self._discard()
+		self._outstanding.clear()
+		return discarded
 
+	@classmethod
+	def _build_frame(cls, command, stationid = None):
 		txdata = command.serialize()
 		if stationid is None:
-			txdata = bytes([ self._ADDRESS_ALL, 0x00, command.commandid() ]) + txdata
+			txdata = bytes([ cls._ADDRESS_ALL, 0x00, command.commandid() ]) + txdata
 		else:
-			txdata = bytes([ self._ADDRESS_STATION_ID, stationid, command.commandid() ]) + txdata
-		txdata = self._enframe(txdata)
-		self._data_debug("-> TX", txdata)
-		self._conn.write(txdata)
+			txdata = bytes([ cls._ADDRESS_STATION_ID, stationid, command.commandid() ]) + txdata
+		return cls._enframe(txdata)
 
-		rxdata = self.read(readlength, short_read_okay = short_read_okay)
+	@classmethod
+	def _parse_frame(cls, rspclass, rxdata):
+		readlength = rspclass.readlength()
 		if len(rxdata) == 0:
-			raise Exception("No response from device when trying to read %d bytes" % (readlength))
-		if not self._checkframe(rxdata):
-			raise Exception("Received checksum incorrect in %d byte frame: %s" % (len(rxdata), rxdata.hex()))
+			raise RC4TimeoutException("No response from device when trying to read %d bytes" % (readlength))
+		if not cls._checkframe(rxdata):
+			raise RC4FrameException("Received checksum incorrect in %d byte frame: %s" % (len(rxdata), rxdata.hex()))
 
 		response = rspclass(rxdata)
 		if not response.lengthok():
-			raise Exception("Short read, read %d bytes but received %d bytes." % (readlength, len(rxdata)))
+			raise RC4FrameException("Short read, read %d bytes but received %d bytes." % (readlength, len(rxdata)))
+		return response
+
+	def require_settle(self):
+		# The device needs some time after certain commands before it accepts
+		# the next one. Waiting is deferred until the next transmission.
+		self._settle_deadline = self._monotonic() + self._timing.settle_time
+
+	def _await_ready(self):
+		# Instead of sleeping for the whole settle time, probe the device
+		# with NOPs until it acknowledges one or the settle time has passed
+		deadline = self._settle_deadline
+		self._settle_deadline = None
+		nop_length = CommandNop.Response.readlength()
+		probes = 0
+		acknowledged = False
+		self._conn.timeout = self._timing.ready_poll_interval
+		try:
+			while self._monotonic() < deadline:
+				self._transmit_frame(self._build_frame(CommandNop()))
+				probes += 1
+				rxdata = self.read(nop_length, short_read_okay = True)
+				if (len(rxdata) == nop_length) and self._checkframe(rxdata):
+					self._data_debug("<- RX", rxdata)
+					acknowledged = True
+					break
+				self._discard()
+			if probes > (1 if acknowledged else 0):
+				# Acknowledgements of probes that are still outstanding may
+				# arrive late and must not be taken for the next response
+				self._discard()
+		finally:
+			self._conn.timeout = self._timing.read_timeout
+
+	def _transmit_frame(self, txdata):
+		self._data_debug("-> TX", txdata)
+		self._conn.write(txdata)
+		self._metrics.tx_bytes += len(txdata)
+
+	def transmit(self, command, stationid = None):
+		if self._settle_deadline is not None:
+			self._await_ready()
+		txdata = self._build_frame(command, stationid = stationid)
+		self._transmit_frame(txdata)
+		# Responses arrive in the order of requests, even when pipelined, so
+		# every response belongs to the oldest outstanding request
+		metrics = self._metrics.command(command.__class__.__name__)
+		metrics.requests += 1
+		metrics.tx_bytes += len(txdata)
+		self._outstanding.append((metrics, self._monotonic()))
 
+	def receive(self, rspclass, short_read_okay = False, length = None):
+		(metrics, sent) = self._outstanding.popleft() if (len(self._outstanding) > 0) else (None, None)
+		try:
+			if length is None:
+				rxdata = self.read(rspclass.readlength(), short_read_okay = short_read_okay)
+			else:
+				rxdata = self.read(length)
+				if length < rspclass.readlength():
+					# The device may have recorded more data since its status was
+					# queried, in which case the frame is longer than expected.
+					# Such a truncated frame may even pass the checksum by chance,
+					# which shows in further bytes already having arrived.
+					if self._checkframe(rxdata):
+						if self._conn.in_waiting > 0:
+							self._discard()
+					else:
+						rxdata += self.read(rspclass.readlength() - length, short_read_okay = True)
+			response = self._parse_frame(rspclass, rxdata)
+		except RC4TimeoutException:
+			if metrics is not None:
+				metrics.timeouts += 1
+			raise
+		except RC4FrameException:
+			if metrics is not None:
+				metrics.checksum_errors += 1
+			raise
+		if metrics is not None:
+			metrics.add_latency(self._monotonic() - sent)
+			metrics.rx_bytes += len(rxdata)
 		self._data_debug("<- RX", rxdata)
 		return response
 
+	def _retries_for(self, command):
+		if command.IDEMPOTENT or self._retry_writes:
+			return self._retries
+		return 0
+
+	def _count_retry(self, command, attempt, exception):
+		self._metrics.command(command.__class__.__name__).retries += 1
+		self._log.info("%s failed (%s), retrying (attempt %d of %d)", command.__class__.__name__, str(exception), attempt, self._retries_for(command))
+
+	def send(self, command, stationid = None, short_read_okay = False, length = None):
+		# After a failed attempt, the line is drained before the request is
+		# repeated so that remainders of the broken frame cannot be mistaken
+		# for the start of the next response
+		attempt = 0
+		while True:
+			self.transmit(command, stationid = stationid)
+			try:
+				return self.receive(command.Response, short_read_okay = short_read_okay, length = length)
+			except RC4CommunicationException as e:
+				if attempt >= self._retries_for(command):
+					raise
+				attempt += 1
+				self._count_retry(command, attempt, e)
+				self.drain()
+
+	def close(self):
+		self._conn.close()
+
 	def bytes2hex(data):
 		return " ".join([ "%02x" % (c) for c in data ])
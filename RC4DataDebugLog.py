@@ -0,0 +1,62 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import queue
+import threading
+from HexDump import HexDump
+
+class RC4DataDebugLog(object):
+	# Can be used as data_debug_callback of a connection. Without a background
+	# thread, frames are dumped right away; with one, the I/O path only
+	# enqueues the raw data and formatting and writing happen in the thread.
+	def __init__(self, f = None, background = False):
+		self._f = f
+		self._hexdump = HexDump()
+		self._queue = None
+		self._thread = None
+		if background:
+			self._queue = queue.Queue()
+			self._thread = threading.Thread(target = self._run, daemon = True)
+			self._thread.start()
+
+	def _format(self, identifier, data):
+		return "%s (%d bytes)\n%s\n" % (identifier, len(data), "".join(line + "\n" for line in self._hexdump.dumpstr(data)))
+
+	def _run(self):
+		while True:
+			entry = self._queue.get()
+			if entry is None:
+				break
+			self._f.write(self._format(*entry))
+			if self._queue.empty():
+				self._f.flush()
+		self._f.flush()
+
+	def __call__(self, identifier, data):
+		if self._queue is not None:
+			self._queue.put((identifier, bytes(data)))
+		else:
+			print(self._format(identifier, data), end = "", file = self._f)
+
+	def close(self):
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
@@ -0,0 +1,110 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import sqlite3
+import collections
+
+DatabaseDevice = collections.namedtuple("DatabaseDevice", [ "id", "deviceid", "userinfo", "intervalsecs", "first", "last" ])
+
+class RC4Database(object):
+	MAGIC = b"SQLite format 3\x00"
+	_SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS devices (
+			id INTEGER PRIMARY KEY,
+			deviceid TEXT NOT NULL UNIQUE,
+			userinfo TEXT NOT NULL
+		)""",
+		"""CREATE TABLE IF NOT EXISTS acquisitions (
+			id INTEGER PRIMARY KEY,
+			device INTEGER NOT NULL REFERENCES devices(id),
+			start INTEGER NOT NULL,
+			intervalsecs INTEGER NOT NULL,
+			UNIQUE (device, start)
+		)""",
+		# Values are in tenths of degrees Celsius. The primary key is the
+		# (device, timestamp) index and at the same time deduplicates samples
+		# of repeated readouts of the same acquisition. Samples of different
+		# acquisitions are all kept, even if their timestamps overlap because
+		# the device clock was changed in between.
+		"""CREATE TABLE IF NOT EXISTS samples (
+			device INTEGER NOT NULL REFERENCES devices(id),
+			timestamp INTEGER NOT NULL,
+			acquisition INTEGER NOT NULL REFERENCES acquisitions(id),
+			value INTEGER NOT NULL,
+			PRIMARY KEY (device, timestamp, acquisition)
+		) WITHOUT ROWID""",
+	]
+
+	def __init__(self, filename, timeout = 30):
+		self._db = sqlite3.connect(filename, timeout = timeout)
+		with self._db:
+			for statement in self._SCHEMA:
+				self._db.execute(statement)
+
+	@staticmethod
+	def is_database(filename):
+		with open(filename, "rb") as f:
+			return f.read(len(RC4Database.MAGIC)) == RC4Database.MAGIC
+
+	def insert(self, deviceid, userinfo, intervalsecs, start, samples):
+		# Returns the number of samples that were not already present
+		with self._db:
+			self._db.execute("INSERT OR IGNORE INTO devices (deviceid, userinfo) VALUES (?, ?)", (deviceid, userinfo))
+			self._db.execute("UPDATE devices SET userinfo = ? WHERE deviceid = ?", (userinfo, deviceid))
+			(device, ) = self._db.execute("SELECT id FROM devices WHERE deviceid = ?", (deviceid, )).fetchone()
+			self._db.execute("INSERT OR IGNORE INTO acquisitions (device, start, intervalsecs) VALUES (?, ?, ?)", (device, start, intervalsecs))
+			(acquisition, ) = self._db.execute("SELECT id FROM acquisitions WHERE (device = ?) AND (start = ?)", (device, start)).fetchone()
+			before = self._db.total_changes
+			self._db.executemany("INSERT OR IGNORE INTO samples (device, timestamp, acquisition, value) VALUES (?, ?, ?, ?)", ((device, start + (index * intervalsecs), acquisition, value) for (index, value) in enumerate(samples)))
+			return self._db.total_changes - before
+
+	def devices(self, deviceids = None, t_from = None, t_to = None):
+		# Devices that have samples in the given time range, together with
+		# the first and last timestamp in that range
+		(condition, args) = self._range_condition(t_from, t_to)
+		result = [ ]
+		for (device, deviceid, userinfo) in self._db.execute("SELECT id, deviceid, userinfo FROM devices ORDER BY deviceid"):
+			if (deviceids is not None) and (deviceid not in deviceids):
+				continue
+			(first, last) = self._db.execute("SELECT MIN(timestamp), MAX(timestamp) FROM samples WHERE device = ?" + condition, (device, ) + args).fetchone()
+			if first is None:
+				continue
+			(intervalsecs, ) = self._db.execute("SELECT intervalsecs FROM acquisitions WHERE (device = ?) AND (start <= ?) ORDER BY start DESC LIMIT 1", (device, last)).fetchone()
+			result.append(DatabaseDevice(id = device, deviceid = deviceid, userinfo = userinfo, intervalsecs = intervalsecs, first = first, last = last))
+		return result
+
+	@staticmethod
+	def _range_condition(t_from, t_to):
+		condition = ""
+		args = ()
+		if t_from is not None:
+			condition += " AND (timestamp >= ?)"
+			args += (t_from, )
+		if t_to is not None:
+			condition += " AND (timestamp < ?)"
+			args += (t_to, )
+		return (condition, args)
+
+	def samples(self, device, t_from = None, t_to = None):
+		(condition, args) = self._range_condition(t_from, t_to)
+		return self._db.execute("SELECT timestamp, value FROM samples WHERE device = ?" + condition + " ORDER BY timestamp, acquisition", (device.id, ) + args)
+
+	def close(self):
+		self._db.close()
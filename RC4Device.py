@@ -18,37 +18,98 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import time
+import array
 import datetime
 import calendar
 import logging
 import json
+import fractions
 
+from RC4Connection import RC4CommunicationException
+from RC4Archive import RC4Archive
+from RC4Database import RC4Database
+from CompressedFile import CompressedFile
 from Commands import CommandGetParameters, CommandDownloadDataPage, CommandStopAcquisition, CommandGetDataInit
 from Commands import CommandNop, CommandSetID, CommandSetUserInfo, CommandSetDatetime, CommandSetParameters
 
 class RC4Readout(object):
-	def __init__(self, params, data):
+	def __init__(self, params, samples, pages = None):
 		self._readoutdate = datetime.datetime.utcnow()
 		self._params = params
-		self._data = data
+		self._samples = samples
+		self._pages = pages
+
+	@classmethod
+	def from_pages(cls, params, pages):
+		samples = array.array("h")
+		for page in pages:
+			samples += page.samples
+		del samples[params.datapts:]
+		return cls(params, samples, pages = pages)
+
+	@property
+	def params(self):
+		return self._params
+
+	@property
+	def samples(self):
+		return self._samples
+
+	@property
+	def pages(self):
+		# The received data page responses, if the readout was made from them
+		return self._pages
+
+	@property
+	def data(self):
+		return [ fractions.Fraction(value, 10) for value in self._samples ]
 
 	def write_txt(self, f):
 		print("# Readout of RC-4 device on %s UTC" % (self._readoutdate.strftime("%Y-%m-%d %H:%M:%S")), file = f)
 		print("# Device ID          : %s" % (self._params.deviceid), file = f)
 		print("# User Info          : %s" % (self._params.userinfo), file = f)
-		print("# Data points        : %d" % (len(self._data)), file = f)
+		print("# Data points        : %d" % (len(self._samples)), file = f)
 		print("# Interval time      : %d secs" % (self._params.intervalsecs), file = f)
 		print("# Start of data      : %s" % (self._params.startdatetime.strftime("%Y-%m-%d %H:%M:%S")), file = f)
 		print("# End of data        : %s" % (self._params.enddatetime.strftime("%Y-%m-%d %H:%M:%S")), file = f)
 		print("# Current date       : %s" % (self._params.currentdatetime.strftime("%Y-%m-%d %H:%M:%S")), file = f)
 		print("# Unit of acquisition: °C", file = f)
 		print(file = f)
-		delta = datetime.timedelta(0, self._params.intervalsecs)
-		for (index, datapoint) in enumerate(self._data):
-			timestamp = self._params.startdatetime + (index * delta)
-			timet = calendar.timegm(timestamp.utctimetuple())
-			print("%d	%s	%.1f" % (timet, timestamp.strftime("%Y-%m-%d %H:%M:%S"), datapoint), file = f)
+		for chunk in self._txt_chunks():
+			f.write(chunk)
+
+	def _txt_chunks(self, rows_per_chunk = 4096):
+		# Timestamps are advanced arithmetically from the start of the
+		# acquisition. The date part only changes once a day, the time of day
+		# and value strings repeat, so all of them are formatted only once.
+		epoch = datetime.datetime(1970, 1, 1)
+		interval = self._params.intervalsecs
+		timet = calendar.timegm(self._params.startdatetime.utctimetuple())
+		next_day = timet
+		timestrs = { }
+		valuestrs = { }
+		rows = [ ]
+		for value in self._samples:
+			if timet >= next_day:
+				day = timet // 86400
+				datestr = (epoch + datetime.timedelta(day)).strftime("%Y-%m-%d")
+				next_day = (day + 1) * 86400
+			secs = timet % 86400
+			timestr = timestrs.get(secs)
+			if timestr is None:
+				timestr = timestrs[secs] = "%02d:%02d:%02d" % (secs // 3600, secs % 3600 // 60, secs % 60)
+			valuestr = valuestrs.get(value)
+			if valuestr is None:
+				valuestr = valuestrs[value] = "%.1f" % (value / 10)
+			rows.append("%d\t%s %s\t%s\n" % (timet, datestr, timestr, valuestr))
+			if len(rows) >= rows_per_chunk:
+				yield "".join(rows)
+				rows = [ ]
+			timet += interval
+		if len(rows) > 0:
+			yield "".join(rows)
 
 	@staticmethod
 	def _ts_json(ts):
@@ -57,7 +118,34 @@ class RC4Readout(object):
 			"iso":			ts.isoformat(timespec = "seconds"),
 		}
 
-	def write_json(self, f):
+	def _json_points(self, compact, values_per_chunk = 4096):
+		# Yields the serialized points array piece by piece, formatted exactly
+		# like json.dumps() would do it at this nesting level
+		if len(self._samples) == 0:
+			yield "[]"
+			return
+		if compact:
+			(opening, separator, closing) = ("[", ",", "]")
+			formatter = str
+		else:
+			(opening, separator, closing) = ("[\n" + (" " * 12), ",\n" + (" " * 12), "\n" + (" " * 8) + "]")
+			formatter = lambda value: repr(value / 10)
+		valuestrs = { }
+		for offset in range(0, len(self._samples), values_per_chunk):
+			strs = [ ]
+			for value in self._samples[offset : offset + values_per_chunk]:
+				valuestr = valuestrs.get(value)
+				if valuestr is None:
+					valuestr = valuestrs[value] = formatter(value)
+				strs.append(valuestr)
+			yield (opening if (offset == 0) else separator) + separator.join(strs)
+		yield closing
+
+	def write_json(self, f, compact = False):
+		# The document is serialized with a placeholder for the points, which
+		# are then streamed into it. In compact mode, points are stored as
+		# integers that need to be divided by "divisor".
+		placeholder = "\x00points\x00"
 		json_data = {
 			"readout_ts_utc":	self._ts_json(self._readoutdate),
 			"device": {
@@ -65,64 +153,205 @@ class RC4Readout(object):
 				"user_info":	self._params.userinfo,
 			},
 			"data": {
-				"count":		len(self._data),
+				"count":		len(self._samples),
 				"unit":			"C",
 				"interval":		self._params.intervalsecs,
 				"start":		self._ts_json(self._params.startdatetime),
 				"end":			self._ts_json(self._params.enddatetime),
 				"now":			self._ts_json(self._params.currentdatetime),
-				"points":		[ float(value) for value in self._data ],
+				"points":		placeholder,
 			},
 		}
-		print(json.dumps(json_data, sort_keys = True, indent = 4), file = f)
+		if compact:
+			json_data["data"]["divisor"] = 10
+			text = json.dumps(json_data, sort_keys = True, separators = (",", ":"))
+		else:
+			text = json.dumps(json_data, sort_keys = True, indent = 4)
+		(head, tail) = text.split(json.dumps(placeholder))
+		f.write(head)
+		for chunk in self._json_points(compact):
+			f.write(chunk)
+		f.write(tail + "\n")
+
+	def write_bin(self, f, delta = False):
+		start = calendar.timegm(self._params.startdatetime.timetuple())
+		readout = calendar.timegm(self._readoutdate.timetuple())
+		RC4Archive.write(f, self._params.deviceid, self._params.userinfo, self._params.intervalsecs, start, readout, self._samples, delta = delta)
+
+	def write_sqlite(self, filename):
+		# Appends to the database; samples that are already present from an
+		# earlier readout of the same acquisition are skipped
+		start = calendar.timegm(self._params.startdatetime.timetuple())
+		db = RC4Database(filename)
+		try:
+			return db.insert(self._params.deviceid, self._params.userinfo, self._params.intervalsecs, start, self._samples)
+		finally:
+			db.close()
+
+	def save(self, filename, fileformat, delta = False, compact = False):
+		if fileformat == "sqlite":
+			self.write_sqlite(filename)
+			return
+		# Written to a temporary file first so readers never see partial data.
+		# Filenames ending in .gz, .xz or .bz2 are compressed accordingly.
+		if fileformat == "bin":
+			with CompressedFile.open(filename + ".tmp", "wb", codec_filename = filename) as f:
+				self.write_bin(f, delta = delta)
+		else:
+			with CompressedFile.open(filename + ".tmp", "w", codec_filename = filename) as f:
+				if fileformat == "txt":
+					self.write_txt(f)
+				elif fileformat == "json":
+					self.write_json(f, compact = compact)
+				else:
+					raise Exception(NotImplemented)
+		os.rename(filename + ".tmp", filename)
+
+class RC4DeviceBase(object):
+	# The protocol logic is written as generators that yield every call they
+	# need to make on the connection as (method name, args, kwargs) and get
+	# back its result. RC4Device executes these calls directly, RC4AsyncDevice
+	# awaits them, so both share everything but the I/O.
+	_log = None
 
-class RC4Device(object):
-	_log = logging.getLogger("pydatalog.RC4Device")
 	def __init__(self, conn):
 		self._conn = conn
+		self._pipelining_ok = True
 
-	def getstatus(self):
-		params = self._conn.send(CommandGetParameters())
-		time.sleep(0.2)
+	@property
+	def conn(self):
+		return self._conn
+
+	@staticmethod
+	def _call(name, *args, **kwargs):
+		return (name, args, kwargs)
+
+	def _getstatus(self):
+		params = yield self._call("send", CommandGetParameters())
+		self._conn.require_settle()
 		return params
 
-	def readout(self):
-		params = self.getstatus()
-		pages = (params.datapts + 99) // 100
+	@staticmethod
+	def _page_length(params, pageno):
+		datapts = min(params.datapts - (100 * pageno), 100)
+		return 2 + (2 * datapts)
 
-		self._conn.send(CommandGetDataInit(), stationid = params.stationid)
+	def _readout_pipelined(self, params, first_page, pages, depth):
+		# Responses carry no page number, so a dropped or merged frame shifts
+		# everything that follows. Any error therefore discards the pipelined
+		# result entirely and the caller falls back to lock-step.
+		responses = [ ]
+		requested = first_page
+		try:
+			for pageno in range(first_page, pages):
+				while (requested < pages) and (requested - pageno < depth):
+					yield self._call("transmit", CommandDownloadDataPage(requested), stationid = params.stationid)
+					requested += 1
+				self._log.debug("Reading page %d (%.0f%%), %d requests in flight", pageno, pageno / pages * 100, requested - pageno)
+				rsp = yield self._call("receive", CommandDownloadDataPage.Response, length = self._page_length(params, pageno))
+				responses.append(rsp)
+		except RC4CommunicationException as e:
+			self._log.warning("Pipelined download failed at page %d (%s), falling back to lock-step mode.", pageno, str(e))
+			self._pipelining_ok = False
+			yield self._call("drain")
+			return None
+		return responses
 
-		data = [ ]
-		self._log.info("%d data points on device in %d pages", params.datapts, pages)
-		for pageno in range(pages):
+	def _readout_lockstep(self, params, first_page, pages):
+		responses = [ ]
+		for pageno in range(first_page, pages):
 			self._log.debug("Reading page %d (%.0f%%)", pageno, pageno / pages * 100)
-			rsp = self._conn.send(CommandDownloadDataPage(pageno), stationid = params.stationid, short_read_okay = (pageno == pages - 1))
-			if len(rsp.data) == 0:
+			rsp = yield self._call("send", CommandDownloadDataPage(pageno), stationid = params.stationid, length = self._page_length(params, pageno))
+			if rsp.datapts == 0:
 				break
-			data += rsp.data
+			responses.append(rsp)
+		return responses
+
+	def _readout(self, pipeline, params, cache):
+		if params is None:
+			params = yield from self._getstatus()
+		pages = (params.datapts + 99) // 100
+
+		cached = [ ] if (cache is None) else cache.load(params)
+		cached = cached[ : params.datapts // 100]
+		first_page = len(cached)
+
+		self._log.info("%d data points on device in %d pages, %d pages cached", params.datapts, pages, first_page)
+		retries_before = self._conn.total_retries
+		t0 = time.monotonic()
+		responses = [ ]
+		if first_page < pages:
+			yield self._call("send", CommandGetDataInit(), stationid = params.stationid)
+			responses = None
+			if (pipeline > 1) and self._pipelining_ok:
+				responses = yield from self._readout_pipelined(params, first_page, pages, pipeline)
+				if responses is None:
+					yield self._call("send", CommandGetDataInit(), stationid = params.stationid)
+			if responses is None:
+				responses = yield from self._readout_lockstep(params, first_page, pages)
 		self._log.debug("All pages read.")
+		if len(responses) > 0:
+			elapsed = time.monotonic() - t0
+			rxbytes = sum(len(rsp.frame) for rsp in responses)
+			self._conn.metrics.add_readout(len(responses), rxbytes, elapsed)
+			self._log.info("Downloaded %d pages in %.2f secs (%.1f pages/s, %.0f bytes/s)", len(responses), elapsed, len(responses) / elapsed, rxbytes / elapsed)
+		if self._conn.total_retries > retries_before:
+			self._log.info("%d retries were necessary during readout.", self._conn.total_retries - retries_before)
 
-		data = data[:params.datapts]
-		return RC4Readout(params, data)
+		responses = cached + responses
+		if cache is not None:
+			cache.store(params, responses)
+		return RC4Readout.from_pages(params, responses)
+
+	def _command(self, command):
+		return (yield self._call("send", command))
+
+class RC4Device(RC4DeviceBase):
+	_log = logging.getLogger("pydatalog.RC4Device")
+
+	def _run(self, operations):
+		try:
+			operation = next(operations)
+			while True:
+				(name, args, kwargs) = operation
+				try:
+					result = getattr(self._conn, name)(*args, **kwargs)
+				except Exception as e:
+					operation = operations.throw(e)
+				else:
+					operation = operations.send(result)
+		except StopIteration as e:
+			return e.value
+
+	def getstatus(self):
+		return self._run(self._getstatus())
+
+	def readout(self, pipeline = 1, params = None, cache = None):
+		return self._run(self._readout(pipeline, params, cache))
 
 	def nop(self):
-		self._conn.send(CommandNop())
+		self._run(self._command(CommandNop()))
 
 	def stopacquisition(self):
-		self._conn.send(CommandStopAcquisition())
+		self._run(self._command(CommandStopAcquisition()))
+
+	def setdatetime(self, timestamp):
+		self._run(self._command(CommandSetDatetime(timestamp)))
 
 	def synclocaltime(self):
-		self._conn.send(CommandSetDatetime(datetime.datetime.now()))
+		self.setdatetime(datetime.datetime.now())
 
 	def syncutctime(self):
-		self._conn.send(CommandSetDatetime(datetime.datetime.utcnow()))
+		self.setdatetime(datetime.datetime.utcnow())
 
 	def setup(self, logintvl):
-		cmd = CommandSetParameters(logintvl = logintvl)
-		self._conn.send(cmd)
+		self._run(self._command(CommandSetParameters(logintvl = logintvl)))
 
 	def set_userinfo(self, info):
-		self._conn.send(CommandSetUserInfo(info))
+		self._run(self._command(CommandSetUserInfo(info)))
 
 	def set_idinfo(self, info):
-		self._conn.send(CommandSetID(info))
+		self._run(self._command(CommandSetID(info)))
+
+	def close(self):
+		self._conn.close()
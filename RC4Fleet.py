@@ -0,0 +1,270 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import glob
+import time
+import heapq
+import random
+import logging
+import itertools
+import concurrent.futures
+
+class RC4FleetDevice(object):
+	def __init__(self, devpath, rc4dev, params):
+		self._devpath = devpath
+		self._rc4dev = rc4dev
+		self.params = params
+
+	@property
+	def devpath(self):
+		return self._devpath
+
+	@property
+	def rc4dev(self):
+		return self._rc4dev
+
+	@property
+	def identity(self):
+		return (self.params.deviceid, self.params.stationid)
+
+class RC4Fleet(object):
+	_log = logging.getLogger("pydatalog.RC4Fleet")
+
+	# Also the defaults of the "fleet" command line options
+	DEFAULT_POLL_INTERVAL = 60
+	DEFAULT_READOUT_INTERVAL = 3600
+	DEFAULT_JITTER = 0.1
+	DEFAULT_DEADLINE = 120
+	DEFAULT_SCAN_INTERVAL = 5
+
+	def __init__(self, patterns, connect, disconnect = None, poll_interval = DEFAULT_POLL_INTERVAL, readout_interval = DEFAULT_READOUT_INTERVAL, jitter = DEFAULT_JITTER, deadline = DEFAULT_DEADLINE, scan_interval = DEFAULT_SCAN_INTERVAL, pipeline = 1, cache = None, on_status = None, on_readout = None, max_workers = 16):
+		self._patterns = patterns
+		self._connect = connect
+		self._disconnect = disconnect
+		self._poll_interval = poll_interval
+		self._readout_interval = readout_interval
+		self._jitter = jitter
+		self._deadline = deadline
+		self._scan_interval = scan_interval
+		self._pipeline = pipeline
+		self._cache = cache
+		self._on_status = on_status
+		self._on_readout = on_readout
+		self._random = random.Random()
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+		self._devices = { }
+		self._schedule = [ ]
+		self._sequence = itertools.count()
+		self._running = { }
+		self._blocked = { }
+		self._abandoned = [ ]
+		self._backoff = { }
+		self._present = set()
+		self._next_scan = 0
+
+	@property
+	def devices(self):
+		return list(self._devices.values())
+
+	def _jittered(self, interval):
+		return interval * (1 + self._random.uniform(-self._jitter, self._jitter))
+
+	def _enqueue(self, fleetdev, job, delay):
+		heapq.heappush(self._schedule, (time.monotonic() + delay, next(self._sequence), fleetdev, job))
+
+	def _scan(self):
+		# Several names (e.g. /dev/serial/by-id links) may refer to the same
+		# port, only the first one found is used
+		present = set()
+		realpaths = set()
+		for pattern in self._patterns:
+			for devpath in sorted(glob.glob(pattern)):
+				realpath = os.path.realpath(devpath)
+				if realpath not in realpaths:
+					realpaths.add(realpath)
+					present.add(devpath)
+
+		for devpath in present - self._present:
+			self._log.info("%s: Device appeared", devpath)
+		for devpath in self._present - present:
+			self._log.info("%s: Device disappeared", devpath)
+			self._backoff.pop(devpath, None)
+			if (devpath in self._devices) and (devpath not in self._running):
+				self._remove(devpath)
+		self._present = present
+
+		now = time.monotonic()
+		for devpath in present:
+			if (devpath in self._backoff) and (now < self._backoff[devpath][0]):
+				continue
+			if (devpath not in self._devices) and (devpath not in self._running) and (devpath not in self._blocked):
+				self._submit(devpath, "identify", self._identify, devpath)
+
+	def _close_device(self, devpath, rc4dev):
+		try:
+			if self._disconnect is not None:
+				self._disconnect(rc4dev)
+			else:
+				rc4dev.close()
+		except Exception as e:
+			self._log.debug("%s: Closing device failed: %s", devpath, str(e))
+
+	def _close(self, fleetdev):
+		self._close_device(fleetdev.devpath, fleetdev.rc4dev)
+
+	def _remove(self, devpath):
+		self._close(self._devices.pop(devpath))
+
+	def _submit(self, devpath, job, fn, *args):
+		# The deadline only starts once a worker has picked up the job, so
+		# that jobs waiting for a free worker are not abandoned
+		started = [ ]
+		def run():
+			started.append(time.monotonic())
+			return fn(*args)
+		future = self._executor.submit(run)
+		self._running[devpath] = (future, started, job)
+
+	def _identify(self, devpath):
+		rc4dev = self._connect(devpath)
+		try:
+			params = rc4dev.getstatus()
+		except Exception:
+			self._close_device(devpath, rc4dev)
+			raise
+		return RC4FleetDevice(devpath, rc4dev, params)
+
+	def _identify_failed(self, devpath):
+		# Ports without a (working) logger are tried again less and less often
+		delay = self._scan_interval
+		if devpath in self._backoff:
+			delay = min(2 * self._backoff[devpath][1], self._readout_interval)
+		self._backoff[devpath] = (time.monotonic() + delay, delay)
+		return delay
+
+	def _poll(self, fleetdev):
+		fleetdev.params = fleetdev.rc4dev.getstatus()
+		if self._on_status is not None:
+			self._on_status(fleetdev, fleetdev.params)
+
+	def _readout(self, fleetdev):
+		readout = fleetdev.rc4dev.readout(pipeline = self._pipeline, cache = self._cache)
+		fleetdev.params = readout.params
+		if self._on_readout is not None:
+			self._on_readout(fleetdev, readout)
+
+	def _register(self, fleetdev):
+		self._backoff.pop(fleetdev.devpath, None)
+		if fleetdev.devpath not in self._present:
+			self._close(fleetdev)
+			return
+		for other in self._devices.values():
+			if other.identity == fleetdev.identity:
+				self._log.error("%s: Device %s with station ID %d is already served on %s, ignoring.", fleetdev.devpath, fleetdev.params.deviceid, fleetdev.params.stationid, other.devpath)
+				self._close(fleetdev)
+				# Not identified again until it is unplugged
+				self._blocked[fleetdev.devpath] = None
+				return
+		self._log.info("%s: Identified device %s (%s) with station ID %d", fleetdev.devpath, fleetdev.params.deviceid, fleetdev.params.userinfo, fleetdev.params.stationid)
+		self._devices[fleetdev.devpath] = fleetdev
+		# Random initial offsets spread the devices over the polling interval
+		# instead of having them all start at the same time
+		self._enqueue(fleetdev, "poll", self._random.uniform(0, self._poll_interval))
+		self._enqueue(fleetdev, "readout", self._random.uniform(0, self._poll_interval))
+
+	def _reap(self):
+		now = time.monotonic()
+		for (devpath, (future, started, job)) in list(self._running.items()):
+			if future.done():
+				del self._running[devpath]
+				try:
+					result = future.result()
+				except Exception as e:
+					if job == "identify":
+						self._log.error("%s: %s failed: %s, trying again in %g seconds", devpath, job, str(e), self._identify_failed(devpath))
+					else:
+						self._log.error("%s: %s failed: %s", devpath, job, str(e))
+					if devpath in self._devices:
+						self._remove(devpath)
+					continue
+				if job == "identify":
+					self._register(result)
+				elif devpath not in self._present:
+					self._remove(devpath)
+			elif (len(started) > 0) and (now - started[0] > self._deadline):
+				# The worker thread cannot be interrupted, so the device is
+				# abandoned until it returns. Its port is only closed then, as
+				# the worker may still be using it.
+				self._log.error("%s: %s did not finish within %g seconds, abandoning device.", devpath, job, self._deadline)
+				del self._running[devpath]
+				self._blocked[devpath] = future
+				self._abandoned.append((future, job, self._devices.pop(devpath, None)))
+
+		for (future, job, fleetdev) in list(self._abandoned):
+			if future.done():
+				self._abandoned.remove((future, job, fleetdev))
+				if (job == "identify") and (future.exception() is None):
+					fleetdev = future.result()
+				if fleetdev is not None:
+					self._close(fleetdev)
+
+		for (devpath, future) in list(self._blocked.items()):
+			if devpath not in self._present:
+				del self._blocked[devpath]
+			elif (future is not None) and future.done():
+				del self._blocked[devpath]
+
+	def _dispatch(self):
+		now = time.monotonic()
+		while (len(self._schedule) > 0) and (self._schedule[0][0] <= now):
+			(due, seq, fleetdev, job) = heapq.heappop(self._schedule)
+			devpath = fleetdev.devpath
+			if self._devices.get(devpath) is not fleetdev:
+				# Device was removed, its schedule ends here
+				continue
+			if devpath in self._running:
+				# Previous job still running, try again shortly
+				self._enqueue(fleetdev, job, 1)
+				continue
+			if job == "poll":
+				self._submit(devpath, job, self._poll, fleetdev)
+				self._enqueue(fleetdev, job, self._jittered(self._poll_interval))
+			elif job == "readout":
+				self._submit(devpath, job, self._readout, fleetdev)
+				self._enqueue(fleetdev, job, self._jittered(self._readout_interval))
+
+	def step(self):
+		if time.monotonic() >= self._next_scan:
+			self._scan()
+			self._next_scan = time.monotonic() + self._scan_interval
+		self._reap()
+		self._dispatch()
+
+	def run_forever(self, tick = 0.1):
+		while True:
+			self.step()
+			time.sleep(tick)
+
+	def shutdown(self):
+		for devpath in list(self._devices):
+			if devpath not in self._running:
+				self._remove(devpath)
+		self._executor.shutdown(wait = False)
@@ -0,0 +1,131 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+import collections
+
+class RC4CommandMetrics(object):
+	_FIELDS = ("requests", "responses", "latency_sum", "latency_max", "tx_bytes", "rx_bytes", "timeouts", "checksum_errors", "retries")
+
+	def __init__(self):
+		for name in self._FIELDS:
+			setattr(self, name, 0)
+
+	def add_latency(self, latency):
+		self.responses += 1
+		self.latency_sum += latency
+		self.latency_max = max(self.latency_max, latency)
+
+	def to_dict(self):
+		result = { name: getattr(self, name) for name in self._FIELDS }
+		result["latency_avg"] = (self.latency_sum / self.responses) if (self.responses > 0) else None
+		return result
+
+class RC4Metrics(object):
+	_TOTAL_FIELDS = ("tx_bytes", "rx_bytes", "discarded_bytes", "readouts", "readout_pages", "readout_bytes", "readout_secs")
+
+	def __init__(self):
+		self._commands = collections.defaultdict(RC4CommandMetrics)
+		for name in self._TOTAL_FIELDS:
+			setattr(self, name, 0)
+
+	def command(self, name):
+		return self._commands[name]
+
+	@property
+	def commands(self):
+		return dict(self._commands)
+
+	def add_readout(self, pages, rxbytes, secs):
+		self.readouts += 1
+		self.readout_pages += pages
+		self.readout_bytes += rxbytes
+		self.readout_secs += secs
+
+	def to_dict(self):
+		result = { name: getattr(self, name) for name in self._TOTAL_FIELDS }
+		result["commands"] = { name: metrics.to_dict() for (name, metrics) in sorted(self._commands.items()) }
+		return result
+
+	def dump(self, f):
+		print("%-26s %6s %6s %8s %8s %8s %8s %6s %6s %6s" % ("Command", "req", "rsp", "avg/ms", "max/ms", "TX", "RX", "tmout", "cksum", "retry"), file = f)
+		for (name, metrics) in sorted(self._commands.items()):
+			avg = (metrics.latency_sum / metrics.responses * 1000) if (metrics.responses > 0) else 0
+			print("%-26s %6d %6d %8.1f %8.1f %8d %8d %6d %6d %6d" % (name, metrics.requests, metrics.responses, avg, metrics.latency_max * 1000, metrics.tx_bytes, metrics.rx_bytes, metrics.timeouts, metrics.checksum_errors, metrics.retries), file = f)
+		print("Total: %d bytes sent, %d bytes received, %d bytes discarded" % (self.tx_bytes, self.rx_bytes, self.discarded_bytes), file = f)
+		if self.readout_secs > 0:
+			print("Readout: %d pages in %.2f secs, %.1f pages/s, %.0f bytes/s" % (self.readout_pages, self.readout_secs, self.readout_pages / self.readout_secs, self.readout_bytes / self.readout_secs), file = f)
+
+	@staticmethod
+	def _prometheus_escape(text):
+		return text.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+	@classmethod
+	def write_prometheus(cls, f, metrics_by_device):
+		# Text exposition format as read by the node_exporter textfile collector
+		def series(name, mtype, helptext, values):
+			print("# HELP pydatalog_%s %s" % (name, helptext), file = f)
+			print("# TYPE pydatalog_%s %s" % (name, mtype), file = f)
+			for (labels, value) in values:
+				labeltext = ",".join("%s=\"%s\"" % (key, cls._prometheus_escape(str(labelvalue))) for (key, labelvalue) in labels)
+				print("pydatalog_%s{%s} %s" % (name, labeltext, value), file = f)
+
+		def per_command(field):
+			for (device, metrics) in sorted(metrics_by_device.items()):
+				for (command, cmdmetrics) in sorted(metrics.commands.items()):
+					yield ((("device", device), ("command", command)), getattr(cmdmetrics, field))
+
+		def per_device(field):
+			for (device, metrics) in sorted(metrics_by_device.items()):
+				yield ((("device", device), ), getattr(metrics, field))
+
+		series("command_requests_total", "counter", "Commands sent to the device.", per_command("requests"))
+		series("command_responses_total", "counter", "Valid responses received from the device.", per_command("responses"))
+		series("command_latency_seconds_sum", "counter", "Total time between sending a command and receiving its response.", per_command("latency_sum"))
+		series("command_latency_seconds_max", "gauge", "Longest time between sending a command and receiving its response.", per_command("latency_max"))
+		series("command_tx_bytes_total", "counter", "Bytes sent in commands.", per_command("tx_bytes"))
+		series("command_rx_bytes_total", "counter", "Bytes received in valid responses.", per_command("rx_bytes"))
+		series("command_timeouts_total", "counter", "Responses not received in time.", per_command("timeouts"))
+		series("command_checksum_errors_total", "counter", "Responses received with a bad checksum or length.", per_command("checksum_errors"))
+		series("command_retries_total", "counter", "Commands that were repeated after an error.", per_command("retries"))
+		series("tx_bytes_total", "counter", "Bytes sent to the device.", per_device("tx_bytes"))
+		series("rx_bytes_total", "counter", "Bytes received from the device.", per_device("rx_bytes"))
+		series("discarded_bytes_total", "counter", "Received bytes discarded while resynchronizing.", per_device("discarded_bytes"))
+		series("readouts_total", "counter", "Readouts of data pages.", per_device("readouts"))
+		series("readout_pages_total", "counter", "Data pages downloaded during readouts.", per_device("readout_pages"))
+		series("readout_bytes_total", "counter", "Bytes received in data pages during readouts.", per_device("readout_bytes"))
+		series("readout_seconds_total", "counter", "Time spent downloading data pages.", per_device("readout_secs"))
+
+	@staticmethod
+	def write_json(f, metrics_by_device):
+		json_data = { device: metrics.to_dict() for (device, metrics) in metrics_by_device.items() }
+		print(json.dumps(json_data, sort_keys = True, indent = 4), file = f)
+
+	@classmethod
+	def write_file(cls, filename, metrics_by_device):
+		# Files ending in .prom are written for the Prometheus textfile
+		# collector, which requires them to be replaced atomically
+		with open(filename + ".tmp", "w") as f:
+			if filename.endswith(".prom"):
+				cls.write_prometheus(f, metrics_by_device)
+			else:
+				cls.write_json(f, metrics_by_device)
+		os.rename(filename + ".tmp", filename)
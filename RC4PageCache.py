@@ -0,0 +1,101 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import re
+import logging
+from RC4Connection import RC4Connection
+from Commands import CommandDownloadDataPage
+
+class RC4PageCache(object):
+	_log = logging.getLogger("pydatalog.RC4PageCache")
+	_FRAME_LENGTH = CommandDownloadDataPage.Response.readlength()
+
+	def __init__(self, cachedir):
+		self._cachedir = cachedir
+		os.makedirs(self._cachedir, exist_ok = True)
+
+	@staticmethod
+	def default_cachedir():
+		return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pydatalog")
+
+	@staticmethod
+	def _key(params):
+		deviceid = re.sub(r"[^A-Za-z0-9._-]+", "_", params.deviceid)
+		return "%s_%d_%s" % (deviceid, params.stationid, params.startdatetime.strftime("%Y%m%d%H%M%S"))
+
+	@classmethod
+	def _full_pages(cls, pages):
+		for page in pages:
+			if len(page.frame) != cls._FRAME_LENGTH:
+				break
+			yield page
+
+	def _filename(self, params):
+		return os.path.join(self._cachedir, self._key(params) + ".pages")
+
+	def load(self, params):
+		# Only full pages are cached, as raw received frames back to back
+		if params.startdatetime is None:
+			return [ ]
+		try:
+			with open(self._filename(params), "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return [ ]
+
+		pages = [ ]
+		for offset in range(0, len(data) - self._FRAME_LENGTH + 1, self._FRAME_LENGTH):
+			frame = data[offset : offset + self._FRAME_LENGTH]
+			if not RC4Connection._checkframe(frame):
+				self._log.warning("Cache file %s corrupt at page %d, ignoring remainder.", self._filename(params), len(pages))
+				break
+			pages.append(CommandDownloadDataPage.Response(frame))
+		self._log.debug("%d pages cached in %s", len(pages), self._filename(params))
+		return pages
+
+	def store(self, params, pages):
+		if params.startdatetime is None:
+			return
+		frames = bytearray()
+		for page in self._full_pages(pages):
+			frames += page.frame
+		filename = self._filename(params)
+		with open(filename + ".tmp", "wb") as f:
+			f.write(frames)
+		os.rename(filename + ".tmp", filename)
+
+class RC4MemoryPageCache(object):
+	# Same interface as RC4PageCache, but only remembers the pages of the most
+	# recently stored acquisition and never touches the disk
+	def __init__(self):
+		self._key = None
+		self._pages = [ ]
+
+	def load(self, params):
+		if (params.startdatetime is None) or (RC4PageCache._key(params) != self._key):
+			return [ ]
+		return list(self._pages)
+
+	def store(self, params, pages):
+		if params.startdatetime is None:
+			return
+		self._key = RC4PageCache._key(params)
+		self._pages = list(RC4PageCache._full_pages(pages))
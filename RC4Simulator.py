@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sys
+import tty
+import math
+import time
+import random
+import select
+import logging
+import datetime
+import fractions
+import threading
+from Commands import int16, DeviceStateEnum
+from Commands import CommandGetParameters, CommandDownloadDataPage, CommandStopAcquisition, CommandGetDataInit
+from Commands import CommandNop, CommandSetID, CommandSetUserInfo, CommandSetDatetime, CommandSetParameters
+
+class RC4Simulator(object):
+	_log = logging.getLogger("pydatalog.RC4Simulator")
+	_ADDRESS_ALL = 0xcc
+	_ADDRESS_STATION_ID = 0x33
+	_PAYLOAD_LENGTHS = {
+		CommandGetDataInit.commandid():			1,
+		CommandDownloadDataPage.commandid():	1,
+		CommandSetParameters.commandid():		21,
+		CommandGetParameters.commandid():		1,
+		CommandSetDatetime.commandid():			8,
+		CommandStopAcquisition.commandid():		1,
+		CommandSetUserInfo.commandid():			101,
+		CommandNop.commandid():					1,
+		CommandSetID.commandid():				11,
+	}
+
+	def __init__(self, **kwargs):
+		self._stationid = kwargs.get("stationid", 1)
+		self._deviceid = kwargs.get("deviceid", "SIM0000001")
+		self._userinfo = kwargs.get("userinfo", "Simulated RC-4")
+		self._intervalsecs = kwargs.get("intervalsecs", 60)
+		self._pagesize = kwargs.get("pagesize", 100)
+		self._state = kwargs.get("state", DeviceStateEnum.STOPPED)
+		self._alarm_min = fractions.Fraction(-30)
+		self._alarm_max = fractions.Fraction(60)
+		self._temp_cal = fractions.Fraction(0)
+		self._delaytime = fractions.Fraction(0)
+		self._clock_offset = datetime.timedelta(0)
+		self._random = random.Random(kwargs.get("seed", 0))
+		self._drop_rate = kwargs.get("drop_rate", 0)
+		self._corrupt_rate = kwargs.get("corrupt_rate", 0)
+		self._rxbuf = bytearray()
+		self._stats = {
+			"requests":		0,
+			"ignored":		0,
+			"dropped":		0,
+			"corrupted":	0,
+		}
+
+		datapts = kwargs.get("datapts", 1000)
+		self._samples = self._generate_samples(datapts)
+		now = self.currentdatetime.replace(microsecond = 0)
+		self._startdatetime = kwargs.get("startdatetime", now - datetime.timedelta(0, datapts * self._intervalsecs))
+		self._lastaccessdatetime = now
+
+	@property
+	def stats(self):
+		return dict(self._stats)
+
+	@property
+	def samples(self):
+		return self._samples
+
+	@property
+	def currentdatetime(self):
+		return datetime.datetime.utcnow() + self._clock_offset
+
+	def drop_request(self):
+		self._stats["dropped"] += 1
+
+	def _generate_samples(self, count, first = 0):
+		samples = [ ]
+		for i in range(first, first + count):
+			value = 200 + (50 * math.sin(i / 100)) + self._random.randint(-5, 5)
+			samples.append(round(value))
+		return samples
+
+	def _record(self):
+		# While logging, one sample is recorded per elapsed interval
+		if self._state != DeviceStateEnum.LOGGING:
+			return
+		elapsed = (self.currentdatetime - self._startdatetime).total_seconds()
+		count = int(elapsed // self._intervalsecs) - len(self._samples)
+		if count > 0:
+			self._samples += self._generate_samples(count, first = len(self._samples))
+
+	@staticmethod
+	def _enframe(data):
+		return bytes(data) + bytes([ sum(data) & 0xff ])
+
+	def _ack(self, cmdid):
+		return self._enframe(bytes([ self._ADDRESS_STATION_ID, cmdid ]))
+
+	def _rsp_get_parameters(self, payload):
+		rsp = bytearray(CommandGetParameters.Response._LAYOUT.pack(
+			stationid = self._stationid,
+			intervalsecs = self._intervalsecs,
+			alarm_max = self._alarm_max,
+			alarm_min = self._alarm_min,
+			lastaccessdatetime = self._lastaccessdatetime,
+			state = self._state,
+			startdatetime = self._startdatetime,
+			datapts = len(self._samples),
+			currentdatetime = self.currentdatetime,
+			userinfo = self._userinfo,
+			deviceid = self._deviceid,
+			delaytime = self._delaytime,
+			temp_cal = self._temp_cal,
+		))
+		rsp[0] = self._ADDRESS_STATION_ID
+		rsp[2] = CommandGetParameters.commandid()
+		self._lastaccessdatetime = self.currentdatetime.replace(microsecond = 0)
+		return self._enframe(rsp[:-1])
+
+	def _rsp_get_data_init(self, payload):
+		rsp = bytearray(CommandGetDataInit.Response._LAYOUT.pack(startdatetime = self._startdatetime))
+		rsp[0 : 3] = bytes([ self._ADDRESS_STATION_ID, self._stationid, CommandGetDataInit.commandid() ])
+		return self._enframe(rsp[:-1])
+
+	def _rsp_download_data_page(self, payload):
+		pageno = payload[0]
+		page = self._samples[pageno * self._pagesize : (pageno + 1) * self._pagesize]
+		rsp = bytearray([ self._ADDRESS_STATION_ID ])
+		for value in page:
+			rsp += int16(value)
+		return self._enframe(rsp)
+
+	def _rsp_set_parameters(self, payload):
+		request = CommandSetParameters._LAYOUT.unpack(payload)
+		self._intervalsecs = request.loginterval_secs
+		self._alarm_max = fractions.Fraction(request.temp_upper, 10)
+		self._alarm_min = fractions.Fraction(request.temp_lower, 10)
+		self._stationid = request.stationid
+		self._temp_cal = fractions.Fraction(request.temp_calibration, 10)
+		self._samples = [ ]
+		self._startdatetime = self.currentdatetime.replace(microsecond = 0)
+		self._state = DeviceStateEnum.LOGGING
+		return self._ack(CommandSetParameters.commandid())
+
+	def _rsp_set_datetime(self, payload):
+		request = CommandSetDatetime._LAYOUT.unpack(payload)
+		self._clock_offset = request.timestamp - datetime.datetime.utcnow()
+		return self._ack(CommandSetDatetime.commandid())
+
+	def _rsp_stop_acquisition(self, payload):
+		self._state = DeviceStateEnum.STOPPED
+		return self._ack(CommandStopAcquisition.commandid())
+
+	def _rsp_set_user_info(self, payload):
+		self._userinfo = CommandSetUserInfo._LAYOUT.unpack(payload).userinfo
+		return self._ack(CommandSetUserInfo.commandid())
+
+	def _rsp_nop(self, payload):
+		return self._ack(CommandNop.commandid())
+
+	def _rsp_set_id(self, payload):
+		self._deviceid = CommandSetID._LAYOUT.unpack(payload).id
+		return self._ack(CommandSetID.commandid())
+
+	def parse(self, data):
+		# Bytes that cannot start a valid request are skipped to resync
+		self._rxbuf += data
+		while len(self._rxbuf) >= 3:
+			if self._rxbuf[0] not in (self._ADDRESS_ALL, self._ADDRESS_STATION_ID):
+				del self._rxbuf[0]
+				continue
+			payload_length = self._PAYLOAD_LENGTHS.get(self._rxbuf[2])
+			if payload_length is None:
+				del self._rxbuf[0]
+				continue
+			frame_length = 3 + payload_length + 1
+			if len(self._rxbuf) < frame_length:
+				break
+			frame = bytes(self._rxbuf[:frame_length])
+			del self._rxbuf[:frame_length]
+			yield frame
+
+	def process(self, frame):
+		self._stats["requests"] += 1
+		self._record()
+		if (sum(frame[:-1]) & 0xff) != frame[-1]:
+			self._log.debug("Ignoring request with bad checksum: %s", frame.hex())
+			self._stats["ignored"] += 1
+			return None
+		if (frame[0] == self._ADDRESS_STATION_ID) and (frame[1] != self._stationid):
+			self._stats["ignored"] += 1
+			return None
+
+		handler = {
+			CommandGetDataInit.commandid():			self._rsp_get_data_init,
+			CommandDownloadDataPage.commandid():	self._rsp_download_data_page,
+			CommandSetParameters.commandid():		self._rsp_set_parameters,
+			CommandGetParameters.commandid():		self._rsp_get_parameters,
+			CommandSetDatetime.commandid():			self._rsp_set_datetime,
+			CommandStopAcquisition.commandid():		self._rsp_stop_acquisition,
+			CommandSetUserInfo.commandid():			self._rsp_set_user_info,
+			CommandNop.commandid():					self._rsp_nop,
+			CommandSetID.commandid():				self._rsp_set_id,
+		}[frame[2]]
+		response = handler(frame[3:-1])
+
+		if self._random.random() < self._drop_rate:
+			self._stats["dropped"] += 1
+			return None
+		if self._random.random() < self._corrupt_rate:
+			self._stats["corrupted"] += 1
+			response = bytearray(response)
+			response[self._random.randrange(len(response))] ^= self._random.randint(1, 255)
+			response = bytes(response)
+		return response
+
+class _RC4SimulatorLink(object):
+	def __init__(self, simulator, latency = 0, baudrate = None, pipelining = True):
+		self._simulator = simulator
+		self._latency = latency
+		self._bytetime = 0 if (baudrate is None) else (10 / baudrate)
+		self._pipelining = pipelining
+		self._busy_until = 0
+
+	def _schedule(self, data, now):
+		# Without pipelining support, requests that arrive while the device is
+		# still answering the previous one are silently dropped
+		responses = [ ]
+		for frame in self._simulator.parse(data):
+			if (not self._pipelining) and (now < self._busy_until):
+				self._simulator.drop_request()
+				continue
+			response = self._simulator.process(frame)
+			if response is None:
+				continue
+			ready = max(now + self._latency, self._busy_until) + (len(response) * self._bytetime)
+			self._busy_until = ready
+			responses.append((ready, response))
+		return responses
+
+class RC4SimulatorTransport(_RC4SimulatorLink):
+	def __init__(self, simulator, latency = 0, baudrate = None, pipelining = True, timeout = 0.25):
+		_RC4SimulatorLink.__init__(self, simulator, latency = latency, baudrate = baudrate, pipelining = pipelining)
+		self.timeout = timeout
+		self._pending = [ ]
+		self._received = bytearray()
+
+	def _collect(self, now):
+		while (len(self._pending) > 0) and (self._pending[0][0] <= now):
+			self._received += self._pending.pop(0)[1]
+
+	@property
+	def in_waiting(self):
+		self._collect(time.monotonic())
+		return len(self._received)
+
+	def write(self, data):
+		self._pending += self._schedule(data, time.monotonic())
+		return len(data)
+
+	def read(self, length):
+		deadline = time.monotonic() + self.timeout
+		while True:
+			now = time.monotonic()
+			self._collect(now)
+			if (len(self._received) >= length) or (now >= deadline) or (len(self._pending) == 0):
+				break
+			time.sleep(max(0, min(self._pending[0][0], deadline) - now))
+		if (len(self._received) < length) and (len(self._pending) == 0):
+			time.sleep(max(0, deadline - time.monotonic()))
+		result = bytes(self._received[:length])
+		del self._received[:length]
+		return result
+
+	def reset_input_buffer(self):
+		self._collect(time.monotonic())
+		self._received = bytearray()
+
+	def close(self):
+		pass
+
+class RC4SimulatorPTY(_RC4SimulatorLink):
+	def __init__(self, simulator, latency = 0, baudrate = None, pipelining = True):
+		_RC4SimulatorLink.__init__(self, simulator, latency = latency, baudrate = baudrate, pipelining = pipelining)
+		(self._master, self._slave) = os.openpty()
+		tty.setraw(self._slave)
+		self._path = os.ttyname(self._slave)
+		self._running = False
+		self._thread = None
+
+	@property
+	def path(self):
+		return self._path
+
+	def _serve(self):
+		while self._running:
+			(readable, _, _) = select.select([ self._master ], [ ], [ ], 0.1)
+			if len(readable) == 0:
+				continue
+			data = os.read(self._master, 4096)
+			for (ready, response) in self._schedule(data, time.monotonic()):
+				delay = ready - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+				os.write(self._master, response)
+
+	def start(self):
+		self._running = True
+		self._thread = threading.Thread(target = self._serve, daemon = True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._running = False
+		if self._thread is not None:
+			self._thread.join()
+		os.close(self._master)
+		os.close(self._slave)
+
+if __name__ == "__main__":
+	from FriendlyArgumentParser import FriendlyArgumentParser
+	parser = FriendlyArgumentParser(description = "Serve a simulated RC-4 data logger on a pseudo terminal.")
+	parser.add_argument("-n", "--datapts", metavar = "count", type = int, default = 1000, help = "Number of data points stored on the simulated device. Default is %(default)s.")
+	parser.add_argument("-i", "--interval", metavar = "secs", type = int, default = 60, help = "Acquisition interval of the simulated device. Default is %(default)s.")
+	parser.add_argument("--logging", action = "store_true", help = "Start with an acquisition in progress so that new data points are recorded while the simulator runs.")
+	parser.add_argument("--pagesize", metavar = "count", type = int, default = 100, help = "Number of data points per downloaded page. Default is %(default)s.")
+	parser.add_argument("--latency", metavar = "secs", type = float, default = 0.005, help = "Turnaround time of the device for every request. Default is %(default)s.")
+	parser.add_argument("--baudrate", metavar = "baud", type = int, default = 115200, help = "Simulated line speed. Default is %(default)s.")
+	parser.add_argument("--no-pipelining", action = "store_true", help = "Drop requests that arrive while the device is still answering the previous one.")
+	parser.add_argument("--drop-rate", metavar = "p", type = float, default = 0, help = "Probability that a response is dropped. Default is %(default)s.")
+	parser.add_argument("--corrupt-rate", metavar = "p", type = float, default = 0, help = "Probability that a response is corrupted. Default is %(default)s.")
+	args = parser.parse_args(sys.argv[1:])
+
+	state = DeviceStateEnum.LOGGING if args.logging else DeviceStateEnum.STOPPED
+	simulator = RC4Simulator(datapts = args.datapts, intervalsecs = args.interval, state = state, pagesize = args.pagesize, drop_rate = args.drop_rate, corrupt_rate = args.corrupt_rate)
+	pty = RC4SimulatorPTY(simulator, latency = args.latency, baudrate = args.baudrate, pipelining = not args.no_pipelining).start()
+	print("Simulated device listening on %s" % (pty.path))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pty.stop()
@@ -0,0 +1,181 @@
+#	pydatalog - Tool to read out temperature data loggers
+#	Copyright (C) 2015-2018 Johannes Bauer
+#
+#	This file is part of pydatalog.
+#
+#	pydatalog is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pydatalog is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import time
+import struct
+import collections
+from Commands import CommandSetDatetime
+
+class RC4ReplayException(Exception): pass
+
+TraceRecord = collections.namedtuple("TraceRecord", [ "direction", "timestamp", "data" ])
+
+class RC4Trace(object):
+	# A trace is a short header followed by one record per write to or read
+	# from the device, including reads that timed out without data. Every
+	# record stores the direction, the time since the previous record in
+	# microseconds and the transferred bytes.
+	_MAGIC = b"RC4T\x01"
+	_HEADER = struct.Struct("<d")
+	_RECORD = struct.Struct("<BIH")
+	TX = 0
+	RX = 1
+
+	@classmethod
+	def write_header(cls, f, starttime):
+		f.write(cls._MAGIC + cls._HEADER.pack(starttime))
+
+	@classmethod
+	def write_record(cls, f, direction, delta, data):
+		# Pauses of more than about 71 minutes are shortened, which only
+		# matters when replaying at original speed
+		if len(data) > 0xffff:
+			raise Exception("Cannot record transfer of %d bytes at once." % (len(data)))
+		delta_us = min(round(delta * 1e6), 0xffffffff)
+		f.write(cls._RECORD.pack(direction, delta_us, len(data)) + data)
+
+	@classmethod
+	def read(cls, f):
+		if f.read(len(cls._MAGIC)) != cls._MAGIC:
+			raise RC4ReplayException("Not a pydatalog trace file.")
+		f.read(cls._HEADER.size)
+		timestamp = 0
+		while True:
+			header = f.read(cls._RECORD.size)
+			if len(header) < cls._RECORD.size:
+				break
+			(direction, delta_us, length) = cls._RECORD.unpack(header)
+			timestamp += delta_us / 1e6
+			yield TraceRecord(direction = direction, timestamp = timestamp, data = f.read(length))
+
+class RC4RecordingTransport(object):
+	def __init__(self, transport, filename):
+		self._transport = transport
+		self._f = open(filename, "wb")
+		RC4Trace.write_header(self._f, time.time())
+		self._last = time.monotonic()
+
+	def _record(self, direction, data):
+		now = time.monotonic()
+		RC4Trace.write_record(self._f, direction, now - self._last, data)
+		self._last = now
+
+	@property
+	def timeout(self):
+		return self._transport.timeout
+
+	@timeout.setter
+	def timeout(self, value):
+		self._transport.timeout = value
+
+	@property
+	def in_waiting(self):
+		return self._transport.in_waiting
+
+	def write(self, data):
+		self._record(RC4Trace.TX, data)
+		return self._transport.write(data)
+
+	def read(self, length):
+		data = self._transport.read(length)
+		self._record(RC4Trace.RX, data)
+		return data
+
+	def reset_input_buffer(self):
+		self._transport.reset_input_buffer()
+
+	def close(self):
+		if not self._f.closed:
+			self._f.close()
+		self._transport.close()
+
+class RC4ReplayTransport(object):
+	# Every read returns exactly what the recorded read returned, which also
+	# reproduces timeouts and partial reads. Only the pacing depends on the
+	# replay speed.
+	#
+	# Written frames must match the recorded ones, with one exception: the
+	# current time that "synctime" sends necessarily differs from the recorded
+	# one, so only the frame header and the constant first payload byte of a
+	# CommandSetDatetime frame are compared.
+	_SETDATETIME_COMPARED = 4
+	def __init__(self, filename, speed = 1, strict = True):
+		with open(filename, "rb") as f:
+			self._records = collections.deque(RC4Trace.read(f))
+		self._speed = speed
+		self._strict = strict
+		self.timeout = None
+		self._anchor = None
+		self._now = 0
+
+	def _next(self, direction):
+		if len(self._records) == 0:
+			raise RC4ReplayException("Trace ended, but the replay continues.")
+		record = self._records.popleft()
+		if record.direction != direction:
+			raise RC4ReplayException("Replay diverged from trace at %.3f secs: expected a %s, but got a %s." % (record.timestamp, "write" if (record.direction == RC4Trace.TX) else "read", "write" if (direction == RC4Trace.TX) else "read"))
+		self._now = record.timestamp
+		return record
+
+	def _wait(self, record):
+		# Events are timed relative to the most recent request so that delays
+		# on the replaying side do not add up
+		if (self._speed != 0) and (self._anchor is not None):
+			delay = self._anchor + (record.timestamp / self._speed) - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+
+	def monotonic(self):
+		return self._now
+
+	@classmethod
+	def _matches(cls, recorded, data):
+		if recorded == data:
+			return True
+		if (len(recorded) != len(data)) or (len(data) <= cls._SETDATETIME_COMPARED) or (data[2] != CommandSetDatetime.commandid()):
+			return False
+		return recorded[ : cls._SETDATETIME_COMPARED] == data[ : cls._SETDATETIME_COMPARED]
+
+	@property
+	def in_waiting(self):
+		if (len(self._records) > 0) and (self._records[0].direction == RC4Trace.RX):
+			return len(self._records[0].data)
+		return 0
+
+	def write(self, data):
+		record = self._next(RC4Trace.TX)
+		if self._strict and (not self._matches(record.data, bytes(data))):
+			raise RC4ReplayException("Replay diverged from trace at %.3f secs: expected %s to be written, but got %s." % (record.timestamp, record.data.hex(), bytes(data).hex()))
+		if self._speed != 0:
+			self._anchor = time.monotonic() - (record.timestamp / self._speed)
+		return len(data)
+
+	def read(self, length):
+		record = self._next(RC4Trace.RX)
+		if len(record.data) > length:
+			raise RC4ReplayException("Replay diverged from trace at %.3f secs: %d bytes recorded, but only %d bytes read." % (record.timestamp, len(record.data), length))
+		self._wait(record)
+		return record.data
+
+	def reset_input_buffer(self):
+		pass
+
+	def close(self):
+		pass